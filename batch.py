@@ -0,0 +1,132 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from constants import ALL_YEARS_FILE, YEAR_WIKITEXT_FILE, NOMINATIM_ENDPOINT, GEOCODE_RATE, GEOCODE_BURST
+from fnmatch import fnmatch
+from gazetteer import open_gazetteer
+from generate_wikicode import check_format, write_outputs
+from geocache import GeocodeCache
+from geocoder import Geocoder, TokenBucket
+import glob
+import instrumentation
+import os
+import pipeline
+import re
+from records import to_dicts
+from storage import open_store, write_json_atomic
+
+geocoder = None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("years", nargs="+", help="years to process, as a year (2019), a range (2013-2019), or a glob "
+                                                 "matched against the CSV files present (20*)")
+    parser.add_argument("-f", "--format", help="'table', 'map', 'both', 'clustered', or 'geojson'", default="both")
+    parser.add_argument("-p", "--processes", help="number of worker processes", type=int, default=os.cpu_count())
+    parser.add_argument("--no-cache", help="don't read or write the geocoding cache", action="store_true")
+    parser.add_argument("--no-gazetteer", help="don't look up cities in the offline gazetteer", action="store_true")
+    parser.add_argument("--endpoint", help="Nominatim-compatible search endpoint", default=NOMINATIM_ENDPOINT)
+    parser.add_argument("--rate", help="maximum geocoding requests per second, across all workers", type=float,
+                        default=GEOCODE_RATE)
+    parser.add_argument("--skip-merge", help="don't merge in wikitext", action="store_true")
+    args = parser.parse_args()
+    check_format(args.format)
+    return args
+
+
+def find_years(patterns):
+    """Expand year, year range, and glob arguments into a sorted list of years that have a CSV available."""
+    available = sorted(os.path.splitext(os.path.basename(f))[0] for f in glob.glob("[0-9][0-9][0-9][0-9].csv"))
+    years = set()
+    for pattern in patterns:
+        year_range = re.fullmatch(r"(\d{4})-(\d{4})", pattern)
+        if year_range:
+            wanted = [str(y) for y in range(int(year_range.group(1)), int(year_range.group(2)) + 1)]
+        elif re.fullmatch(r"\d{4}", pattern):
+            wanted = [pattern]
+        else:
+            wanted = [year for year in available if fnmatch(year, pattern)]
+        for year in wanted:
+            if year in available:
+                years.add(year)
+            else:
+                print("No CSV found for {}, skipping.".format(year))
+    return sorted(years)
+
+
+def init_worker(bucket_state, endpoint, rate, use_cache, use_gazetteer):
+    """Set up one geocoder per worker process. They all draw from the same token bucket, and share the on-disk
+    cache and gazetteer."""
+    global geocoder
+    geocoder = Geocoder(endpoint=endpoint, cache=GeocodeCache() if use_cache else None,
+                        bucket=TokenBucket(rate, GEOCODE_BURST, shared=bucket_state),
+                        gazetteer=open_gazetteer() if use_gazetteer else None)
+
+
+def run_year(year, fmt, skip_merge):
+    """Run the whole pipeline on one year, merging in the year's wikitext if there is any. Conflicts go to the year's
+    review file instead of prompting."""
+    wikitext = None if skip_merge else YEAR_WIKITEXT_FILE.format(year=year)
+    with instrumentation.run("pipeline", year):
+        store = open_store()
+        pipeline.run(year, geocoder, store, wikitext, fmt, batch=True)
+        store.close()
+    return year
+
+
+def write_combined(years):
+    """Combine every year's entries into one dataset. IDs start with the date, so they're unique across years."""
+    store = open_store()
+    combined = {k: v for k, v in store.load().items() if k[:4] in years}
+    store.close()
+    write_json_atomic(ALL_YEARS_FILE, to_dicts(combined))
+    print("Wrote {} entries from {} years to {}.".format(len(combined), len(years), ALL_YEARS_FILE))
+    return combined
+
+
+def main():
+    args = parse_arguments()
+    years = find_years(args.years)
+    if not years:
+        raise Exception("No years to process.")
+    bucket_state = TokenBucket.shared_state(GEOCODE_BURST)
+
+    with ProcessPoolExecutor(max_workers=args.processes, initializer=init_worker,
+                             initargs=(bucket_state, args.endpoint, args.rate, not args.no_cache,
+                                       not args.no_gazetteer)) as executor:
+        list(executor.map(run_year, years, [args.format] * len(years), [args.skip_merge] * len(years)))
+
+    # Check every year's coordinates together, so duplicates and outliers are found across the whole dataset
+    combined = write_combined(years)
+    try:
+        # NumPy is only needed for validation, so batch processing works without it
+        import validate
+    except ImportError as e:
+        if e.name != "numpy":
+            raise
+        print("NumPy isn't installed, so the coordinates weren't checked. Install it and run validate.py --all --queue.")
+    else:
+        validate.validate(combined, queue=True)
+    if args.format in ['clustered', 'geojson']:
+        write_outputs(combined, "all", args.format)
+
+
+if __name__ == "__main__":
+    main()
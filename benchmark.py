@@ -0,0 +1,301 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+from constants import BENCHMARK_RESULTS_FILE, TABLE_ENTRY_TEMPLATE
+import contextlib
+import csv
+from datetime import datetime, timedelta
+import generate_wikicode
+from geocoder import Geocoder
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import parse_csv
+import parse_wikicode
+from parse_wikicode import iter_rows
+import pipeline
+import random
+import re
+from storage import open_store
+import subprocess
+import tempfile
+import threading
+import time
+
+# The regex parse_wikicode used before it had a tokenizer, kept here for comparison.
+LEGACY_MONTHS_EXPR = "(?:January|February|March|April|May|June|July|August|September|October|November|December)"
+LEGACY_MATCH_REGEX = re.compile(
+    r"(?:\n*\|(?:{{dts\|)?(?P<date>" + LEGACY_MONTHS_EXPR + r" \d+, \d{4})(?:}})?)\n*"
+    r"\|\[\[(?P<wikilink_target>.*\|)?(?P<loc>.*)\]\]\n*"
+    r"\|(?P<killed>\d+).*\n*"
+    r"\|(?P<injured>\d+).*\n*"
+    r"\|'''(?P<total>\d+)'''.*\n*"
+    r"\|(?P<desc>.*?)"
+    r"(?P<ref><ref.*<\/ref>)+\n*", flags=re.IGNORECASE)
+ADVERSARIAL_ROW = "|-\n|{{{{Dts|May 1, 2019}}}}\n|[[Springfield, Illinois]]\n|1\n|3\n|'''4'''\n|Four people were shot.{refs}\n"
+CSV_HEADER = ["Incident Date", "State", "City Or County", "Address", "# Killed", "# Injured", "Operations"]
+# A multi-line cite template with a line that looks like a row separator
+TRICKY_REF = "<ref>{{cite news\n|title=Shooting\n|-\n|url=https://example.com/}}</ref>"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", help="'tokenizer', 'pipeline', or 'generate' to just write synthetic data")
+    parser.add_argument("-w", "--wikitext", help="wikitable body to scale up", default="wikitext.txt")
+    parser.add_argument("-s", "--sample", help="JSON file of real entries to base synthetic data on",
+                        default="2019.json")
+    parser.add_argument("-n", "--incidents", help="number of synthetic incidents", type=int, default=1000)
+    parser.add_argument("-d", "--directory", help="where 'generate' writes its files", default=".")
+    parser.add_argument("-o", "--output", help="file to append results to", default=BENCHMARK_RESULTS_FILE)
+    parser.add_argument("--seed", help="random seed for the synthetic data", type=int, default=0)
+    args = parser.parse_args()
+    if args.benchmark not in ['tokenizer', 'pipeline', 'generate']:
+        raise Exception("Unrecognized benchmark {}. Expected one of 'tokenizer', 'pipeline', or 'generate'."
+                        .format(args.benchmark))
+    return args
+
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def tokenize(text):
+    return sum(1 for _ in iter_rows(io.StringIO(text)))
+
+
+def legacy_tokenize(text):
+    return sum(1 for entry in text.split("|-") if entry and LEGACY_MATCH_REGEX.search(entry))
+
+
+def print_result(label, size, seconds, rows):
+    print("{:<36} {:>10.2f} KB {:>9.4f} s {:>9.0f} KB/s {:>8} rows".format(label, size / 1024, seconds,
+                                                                        size / 1024 / seconds, rows))
+
+
+def benchmark_tokenizer(args):
+    """Time the tokenizer on copies of a real article, and on rows with more and more refs. Throughput should stay
+    roughly flat as the input grows. The old regex is timed on the adversarial rows for comparison: rows whose refs are
+    all self-closing (<ref name=x />) never match it, and it backtracks quadratically before giving up."""
+    with open(args.wikitext, encoding="utf-8") as infile:
+        article = infile.read()
+    results = {}
+
+    print("Article dumps:")
+    for copies in [1, 4, 16, 64]:
+        text = article * copies
+        seconds, rows = time_call(tokenize, text)
+        print_result("tokenizer, {} copies".format(copies), len(text), seconds, rows)
+        results["tokenizer_{}_copies".format(copies)] = seconds
+
+    print("\nRows with many refs:")
+    for count in [250, 500, 1000, 2000, 4000]:
+        text = ADVERSARIAL_ROW.format(refs="<ref>{{cite web|url=https://example.com/|title=Shooting}}</ref>" * count)
+        seconds, rows = time_call(tokenize, text)
+        print_result("tokenizer, {} refs".format(count), len(text), seconds, rows)
+        results["tokenizer_{}_refs".format(count)] = seconds
+        text = ADVERSARIAL_ROW.format(refs='<ref name="source" />' * count)
+        seconds, rows = time_call(tokenize, text)
+        print_result("tokenizer, {} named refs".format(count), len(text), seconds, rows)
+        results["tokenizer_{}_named_refs".format(count)] = seconds
+        seconds, rows = time_call(legacy_tokenize, text)
+        print_result("old regex, {} named refs".format(count), len(text), seconds, rows)
+        results["legacy_regex_{}_named_refs".format(count)] = seconds
+    return results
+
+
+def generate_incidents(sample_path, count, seed=0):
+    """Make up incidents shaped like the real entries in the sample file, with some of the awkward cases that show up
+    in practice: several shootings in one city on the same day, long ref lists, and "|-" inside descriptions and
+    refs."""
+    with open(sample_path, encoding="utf-8") as sample_file:
+        shapes = list(json.load(sample_file).values())
+    rng = random.Random(seed)
+    year = datetime.strptime(shapes[0]["date"], "%Y%m%d").year
+    streets = [re.sub(r"^\d+ ", "", shape["street"]) for shape in shapes if shape["street"]]
+    incidents = []
+    for i in range(count):
+        shape = rng.choice(shapes)
+        if incidents and rng.random() < 0.05:
+            # Another shooting in the same place on the same day
+            previous = incidents[-1]
+            date, city, state = previous["date"], previous["city"], previous["state"]
+        else:
+            date = datetime(year, 1, 1) + timedelta(days=rng.randrange(365))
+            city, state = shape["city"], shape["state"]
+        refs = shape["refs"] or ["<ref>{{cite web|url=https://example.com/}}</ref>"]
+        chance = rng.random()
+        if chance < 0.02:
+            refs = refs * 50
+        elif chance < 0.04:
+            refs = refs + [TRICKY_REF]
+        description = shape["description"] or "Four people were shot."
+        if rng.random() < 0.02:
+            description += " Police said the |- suspect fled."
+        killed = rng.randrange(0, 6)
+        incidents.append({
+            "date": date,
+            "city": city,
+            "state": state,
+            "street": "{} {}".format(rng.randrange(100, 9999), rng.choice(streets)),
+            "killed": killed,
+            "injured": max(4 - killed, 0) + rng.randrange(0, 4),
+            "description": description,
+            "refs": refs
+        })
+    incidents.sort(key=lambda x: x["date"], reverse=True)
+    return incidents
+
+
+def write_csv(path, incidents):
+    with open(path, "w", newline="\n", encoding="utf-8") as csvfile:
+        writer = csv.writer(csvfile, delimiter=",")
+        writer.writerow(CSV_HEADER)
+        for incident in incidents:
+            writer.writerow([incident["date"].strftime("%B %d, %Y"), incident["state"], incident["city"],
+                             incident["street"], incident["killed"], incident["injured"], "N/A"])
+
+
+def write_wikitext(path, incidents, rng):
+    """Write a wikitable body for the incidents. A few disagree with the CSV, or are missing from it, so merging has
+    conflicts to queue and new entries to add."""
+    with open(path, "w", encoding="utf-8") as outfile:
+        outfile.write("|-\n")
+        for incident in incidents:
+            killed = incident["killed"]
+            chance = rng.random()
+            if chance < 0.03:
+                killed += 1
+            city = incident["city"] if chance >= 0.06 else "New " + incident["city"]
+            outfile.write(TABLE_ENTRY_TEMPLATE.format(
+                date=incident["date"].strftime("%B %-d, %Y"), location="{}, {}".format(city, incident["state"]),
+                killed=killed, injured=incident["injured"], total=killed + incident["injured"],
+                desc=incident["description"], refs="".join(incident["refs"])))
+
+
+def generate(args):
+    incidents = generate_incidents(args.sample, args.incidents, args.seed)
+    year = incidents[0]["date"].strftime("%Y")
+    os.makedirs(args.directory, exist_ok=True)
+    write_csv(os.path.join(args.directory, year + ".csv"), incidents)
+    write_wikitext(os.path.join(args.directory, "wikitext.txt"), incidents, random.Random(args.seed))
+    print("Wrote {} incidents for {} to {}.".format(len(incidents), year, args.directory))
+
+
+class FakeNominatim(BaseHTTPRequestHandler):
+    """Stands in for Nominatim, answering every search with a single result somewhere in the US."""
+
+    def do_GET(self):
+        body = json.dumps([{"lat": "39.{}".format(abs(hash(self.path)) % 10 ** 6), "lon": "-98.5795"}])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def fake_nominatim():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeNominatim)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:{}/search".format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def benchmark_pipeline(args):
+    """Time each stage of the pipeline on synthetic data, in a scratch directory, with geocoding answered by a local
+    fake Nominatim server."""
+    sample = os.path.abspath(args.sample)
+    incidents = generate_incidents(sample, args.incidents, args.seed)
+    year = incidents[0]["date"].strftime("%Y")
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory, fake_nominatim() as endpoint:
+        os.chdir(directory)
+        try:
+            write_csv(year + ".csv", incidents)
+            write_wikitext("wikitext.txt", incidents, random.Random(args.seed))
+            geocoder = Geocoder(endpoint=endpoint, rate=1000000, pool_size=8)
+            stages = [
+                ("parse_csv_write", lambda: parse_csv.main(["write", "--year", year, "--no-cache"], geocoder=geocoder)),
+                ("parse_csv_update_unchanged", lambda: parse_csv.main(["update", "--year", year], geocoder=geocoder)),
+                ("parse_wikicode_tokenize", lambda: sum(1 for _ in iter_rows(open("wikitext.txt", encoding="utf-8")))),
+                ("parse_wikicode_merge", lambda: parse_wikicode.main(["--year", year, "--batch"], geocoder=geocoder)),
+                ("generate_wikicode_cold", lambda: generate_wikicode.main(["both", "--year", year, "--full"])),
+                ("generate_wikicode_warm", lambda: generate_wikicode.main(["both", "--year", year])),
+                ("pipeline_update", lambda: pipeline.main(["--year", year, "--wikitext", "wikitext.txt", "--batch"],
+                                                          geocoder=geocoder)),
+                ("pipeline_unchanged", lambda: pipeline.main(["--year", year, "--wikitext", "wikitext.txt", "--batch"],
+                                                             geocoder=geocoder))
+            ]
+            for name, stage in stages:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    seconds, _ = time_call(stage)
+                results[name] = seconds
+                print("{:<28} {:>9.3f} s".format(name, seconds))
+            geocoder.close()
+            store = open_store()
+            results["entries"] = len(store.load(year))
+            store.close()
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def save_results(path, benchmark, incidents, results):
+    """Append a run's results as one line of JSON, so runs can be compared over time."""
+    with open(path, "a", encoding="utf-8") as results_file:
+        results_file.write(json.dumps({
+            "benchmark": benchmark,
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "incidents": incidents if benchmark == "pipeline" else None,
+            "results": results
+        }, sort_keys=True) + "\n")
+
+
+def main():
+    args = parse_arguments()
+    if args.benchmark == "generate":
+        generate(args)
+        return
+    if args.benchmark == "tokenizer":
+        results = benchmark_tokenizer(args)
+    else:
+        results = benchmark_pipeline(args)
+    save_results(args.output, args.benchmark, args.incidents, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from constants import BUILD_CACHE_FILE
+from functools import lru_cache
+import hashlib
+import json
+import os
+from storage import compact, write_json_atomic
+
+
+def file_hash(path):
+    """Hash a file's contents. Returns None if the file doesn't exist, so a missing input is a change like any other."""
+    digest = hashlib.sha1()
+    try:
+        with open(path, "rb") as infile:
+            for chunk in iter(lambda: infile.read(1 << 20), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def code_hash(*modules):
+    """Hash the source of the given modules. Cached for the life of the process, so the hash describes the code that's
+    running, even if the files are edited while watching."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return key(*(file_hash(os.path.join(directory, module + ".py")) for module in modules))
+
+
+def store_hash(shootings_dict):
+    digest = hashlib.sha1()
+    for shooting_id in sorted(shootings_dict):
+        digest.update((shooting_id + compact(shootings_dict[shooting_id]) + "\n").encode("utf-8"))
+    return digest.hexdigest()
+
+
+def key(*parts):
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+class BuildCache:
+    """Remembers the inputs each pipeline stage last ran with, the files it wrote, and the state it left the year's
+    entries in. A stage can be skipped if its inputs haven't changed since, and neither have its outputs."""
+
+    def __init__(self, year, path=BUILD_CACHE_FILE):
+        self.path = path.format(year=year)
+        try:
+            with open(self.path, encoding="utf-8") as cache_file:
+                self.record = json.load(cache_file)
+        except FileNotFoundError:
+            self.record = {"store": None, "stages": {}}
+
+    def store_unchanged(self, shootings_hash):
+        """Whether the entries are as the last run left them, i.e. nothing else has saved this year since."""
+        return self.record["store"] == shootings_hash
+
+    def fresh(self, stage, stage_key, outputs=None):
+        recorded = self.record["stages"].get(stage)
+        if not recorded or recorded["key"] != stage_key:
+            return False
+        return recorded["outputs"] == {path: file_hash(path) for path in outputs or []}
+
+    def update(self, stage, stage_key, outputs=None):
+        self.record["stages"][stage] = {"key": stage_key, "outputs": {path: file_hash(path) for path in outputs or []}}
+
+    def save(self, shootings_hash):
+        self.record["store"] = shootings_hash
+        write_json_atomic(self.path, self.record)
@@ -0,0 +1,144 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import re
+
+REF_REGEX = re.compile(r"<ref[^>]*?/>|<ref[^>]*>.*?</ref>", flags=re.IGNORECASE | re.DOTALL)
+OPENING_TAG_REGEX = re.compile(r"<ref(?P<attributes>[^>]*?)(?P<self_closing>/?)>", flags=re.IGNORECASE)
+NAME_REGEX = re.compile(r"""name\s*=\s*(?:"(?P<quoted>[^"]*)"|'(?P<single_quoted>[^']*)'|(?P<bare>[^\s"'/>]+))""",
+                        flags=re.IGNORECASE)
+
+
+def parse_ref(ref):
+    """Parse a <ref> tag into its name, if it has one, any other attributes (like group=), and its body. A self-closing
+    ref, which reuses a named ref defined elsewhere, has no body."""
+    opening = OPENING_TAG_REGEX.match(ref)
+    name = NAME_REGEX.search(opening.group("attributes"))
+    attributes = " ".join(NAME_REGEX.sub("", opening.group("attributes")).split())
+    if opening.group("self_closing"):
+        body = None
+    else:
+        body = ref[opening.end():ref.lower().rindex("</ref>")]
+    return {
+        "text": ref,
+        "name": next(group for group in name.groups() if group is not None).strip() if name else None,
+        "attributes": attributes,
+        "body": body
+    }
+
+
+def ref_id(ref):
+    """A stable ID for a ref, derived from its text, so the same ref gets the same ID in every entry and every year."""
+    return "ref" + hashlib.sha1(ref.encode("utf-8")).hexdigest()[:12]
+
+
+def is_ref_id(ref):
+    """Entries saved before refs were interned hold the refs themselves."""
+    return not ref.startswith("<")
+
+
+def source_key(citation):
+    """Two refs are the same citation if their bodies only differ in whitespace and they have the same attributes
+    apart from the name. Refs citing the same URL with different text (a different access-date or quote, say) are kept
+    apart. Self-closing refs don't cite anything themselves."""
+    if citation["body"] is None:
+        return None
+    return citation["attributes"] + "|" + " ".join(citation["body"].split())
+
+
+def ref_tag(citation, name, body=None):
+    """Rebuild a ref with the given name, keeping its other attributes."""
+    attributes = ' name="{}"'.format(name) + (" " + citation["attributes"] if citation["attributes"] else "")
+    if body is None:
+        return "<ref{} />".format(attributes)
+    return "<ref{}>{}</ref>".format(attributes, body)
+
+
+def intern_refs(entry, citations):
+    """Replace the refs in an entry's dictionary with their IDs, adding any refs that aren't in citations (a dictionary
+    of ID to ref) yet. Returns the IDs that were added. Refs are stored exactly as written, so entries read back the
+    same; refs that only differ in whitespace or name are merged when the table is rendered, by name_refs."""
+    added = []
+    ids = []
+    for ref in entry["refs"]:
+        citation_id = ref_id(ref)
+        if citation_id not in citations:
+            citations[citation_id] = ref
+            added.append(citation_id)
+        ids.append(citation_id)
+    entry["refs"] = ids
+    return added
+
+
+def expand_refs(entry, citations):
+    """Replace the ref IDs in an entry's dictionary with the refs themselves."""
+    try:
+        entry["refs"] = [citations[ref] if is_ref_id(ref) else ref for ref in entry.get("refs", [])]
+    except KeyError as e:
+        raise Exception("Ref {} isn't in the citation store.".format(e.args[0]))
+    return entry
+
+
+def name_refs(rows):
+    """Rewrite the refs in rendered rows of wikicode so that a citation used more than once is defined once, at its
+    first use, and reused by name everywhere else. A citation that already has a name keeps it; otherwise it's named
+    after its ID. Citations used only once are left as they are. Returns the rewritten rows."""
+    matches = [list(REF_REGEX.finditer(row)) for row in rows]
+    parsed = [[parse_ref(match.group(0)) for match in row_matches] for row_matches in matches]
+    citations = [citation for row_citations in parsed for citation in row_citations]
+
+    # Group the refs by citation, and note which names belong to which citation so reuses of any of them can be
+    # redirected
+    uses = {}
+    names = {}
+    for citation in citations:
+        key = source_key(citation)
+        if key is not None:
+            uses[key] = uses.get(key, 0) + 1
+            if citation["name"]:
+                names.setdefault(citation["name"], key)
+    for citation in citations:
+        if citation["body"] is None and citation["name"] in names:
+            uses[names[citation["name"]]] += 1
+
+    source_names = {}
+    for name, key in names.items():
+        source_names.setdefault(key, name)
+    for key, count in uses.items():
+        if count > 1 and key not in source_names:
+            source_names[key] = ref_id(key)
+
+    output = []
+    defined = set()
+    for row, row_matches, row_citations in zip(rows, matches, parsed):
+        pieces = []
+        last = 0
+        for match, citation in zip(row_matches, row_citations):
+            key = source_key(citation) if citation["body"] is not None else names.get(citation["name"])
+            pieces.append(row[last:match.start()])
+            last = match.end()
+            if key is None or uses[key] == 1:
+                pieces.append(match.group(0))
+            elif citation["body"] is not None and key not in defined:
+                defined.add(key)
+                pieces.append(ref_tag(citation, source_names[key], citation["body"]))
+            else:
+                pieces.append(ref_tag(citation, source_names[key]))
+        pieces.append(row[last:])
+        output.append("".join(pieces))
+    return output
@@ -21,7 +21,104 @@ TEMPLATE = "{{{{Location map~|United States|mark=Location dot red.svg|marksize=4
 TABLE_ENTRY_TEMPLATE = "|{{{{Dts|{date}}}}}\n|[[{location}]]\n|{killed}\n|{injured}\n|'''{total}'''\n|{desc}{refs}\n|-\n"
 COMMENT_LOCATION = "<!--{date}: {location}-->"
 COMMENT = "<!--{date}: {city}, {state}-->"
+CLUSTER_TEMPLATE = ("{{{{Location map~|United States|mark=Location dot red.svg|marksize={size}|lat_deg={lat}"
+                    "|lon_deg={lon}}}}}")
+CLUSTER_COMMENT = "<!--{count} shootings, {killed} killed, {injured} injured: {places}-->"
 YEAR = "2019"
 REQUEST_HEADERS = {
     "User-Agent": "Wikipedia United States Mass Shootings Map: https://github.com/molly/mass-shooting-map"
 }
+GEOCODE_CACHE_FILE = "geocode_cache.sqlite"
+GEOCODE_CACHE_TTL = 365 * 24 * 60 * 60  # Seconds a successful lookup is trusted for
+GEOCODE_NEGATIVE_CACHE_TTL = 7 * 24 * 60 * 60  # Seconds before retrying a lookup that found no single result
+GEOCODE_CACHE_MAX_ENTRIES = 100000
+NOMINATIM_ENDPOINT = "https://nominatim.openstreetmap.org/search"
+GEOCODE_RATE = 1.0  # Requests per second, per OSM's usage policy
+GEOCODE_BURST = 1
+GEOCODE_WORKERS = 4
+GEOCODE_MAX_RETRIES = 3
+GEOCODE_BACKOFF = 2.0  # Seconds to wait before the first retry; doubles on each subsequent retry
+GEOCODE_TIMEOUT = 30
+ALL_YEARS_FILE = "all.json"
+YEAR_WIKITEXT_FILE = "{year}_wikitext.txt"
+CITY_AUTO_MATCH_SCORE = 0.85  # Same date and state, and city names at least this similar: treat as the same shooting
+CITY_LIKELY_MATCH_SCORE = 0.5  # ...or at least this similar, and the same number of people killed and injured
+CITY_NO_MATCH_SCORE = 0.3  # Same date and state, but city names this different and victim counts differ: not a match
+REVIEW_FILE = "{year}_review.json"
+CHECKPOINT_FILE = "{year}_checkpoint.json"
+CHECKPOINT_INTERVAL = 30  # Seconds between checkpoints while merging
+RENDER_CACHE_FILE = "{year}_render_cache.json"
+DIFF_FILE = "{year}_diff.txt"
+CLUSTERED_MAP_FILE = "{year}_clustered_map.txt"
+GEOJSON_FILE = "{year}.geojson"
+BUILD_CACHE_FILE = "{year}_build_cache.json"
+WATCH_INTERVAL = 2  # Seconds between checks for changed inputs in watch mode
+CLUSTER_GRID = 1.0  # Degrees of latitude and longitude covered by each cell of the clustered map
+CLUSTER_MIN_MARKSIZE = 4  # Marker size of the cluster with the fewest victims
+CLUSTER_MAX_MARKSIZE = 20  # ...and of the cluster with the most
+CLUSTER_COMMENT_PLACES = 3  # Cities named in each cluster's comment
+STORAGE_BACKEND = "sqlite"  # "sqlite" or "json"
+SQLITE_STORE_FILE = "shootings.sqlite"
+JSON_STORE_FILE = "{year}.json"
+BENCHMARK_RESULTS_FILE = "benchmark_results.jsonl"
+RUN_REPORT_FILE = "{year}_{script}_report.json"
+PROFILE_FILE = "{year}_{script}.prof"
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # Upper bounds, in seconds, of the HTTP latency histogram
+GAZETTEER_FILE = "gazetteer.idx"
+STATE_NAMES = {
+    "AL": "Alabama", "AK": "Alaska", "AZ": "Arizona", "AR": "Arkansas", "CA": "California", "CO": "Colorado",
+    "CT": "Connecticut", "DE": "Delaware", "DC": "District of Columbia", "FL": "Florida", "GA": "Georgia",
+    "HI": "Hawaii", "ID": "Idaho", "IL": "Illinois", "IN": "Indiana", "IA": "Iowa", "KS": "Kansas", "KY": "Kentucky",
+    "LA": "Louisiana", "ME": "Maine", "MD": "Maryland", "MA": "Massachusetts", "MI": "Michigan", "MN": "Minnesota",
+    "MS": "Mississippi", "MO": "Missouri", "MT": "Montana", "NE": "Nebraska", "NV": "Nevada", "NH": "New Hampshire",
+    "NJ": "New Jersey", "NM": "New Mexico", "NY": "New York", "NC": "North Carolina", "ND": "North Dakota",
+    "OH": "Ohio", "OK": "Oklahoma", "OR": "Oregon", "PA": "Pennsylvania", "RI": "Rhode Island",
+    "SC": "South Carolina", "SD": "South Dakota", "TN": "Tennessee", "TX": "Texas", "UT": "Utah", "VT": "Vermont",
+    "VA": "Virginia", "WA": "Washington", "WV": "West Virginia", "WI": "Wisconsin", "WY": "Wyoming",
+    "PR": "Puerto Rico"
+}
+# Bounding box of each state, as (min lat, max lat, min lon, max lon)
+STATE_BOUNDS = {
+    "Alabama": (30.14, 35.01, -88.47, -84.89), "Alaska": (51.21, 71.39, -179.15, -129.98),
+    "Arizona": (31.33, 37.00, -114.82, -109.04), "Arkansas": (33.00, 36.50, -94.62, -89.64),
+    "California": (32.53, 42.01, -124.41, -114.13), "Colorado": (36.99, 41.00, -109.06, -102.04),
+    "Connecticut": (40.98, 42.05, -73.73, -71.79), "Delaware": (38.45, 39.84, -75.79, -75.05),
+    "District of Columbia": (38.79, 38.99, -77.12, -76.91), "Florida": (24.52, 31.00, -87.63, -80.03),
+    "Georgia": (30.36, 35.00, -85.61, -80.84), "Hawaii": (18.91, 22.24, -160.25, -154.81),
+    "Idaho": (41.99, 49.00, -117.24, -111.04), "Illinois": (36.97, 42.51, -91.51, -87.02),
+    "Indiana": (37.77, 41.76, -88.10, -84.78), "Iowa": (40.38, 43.50, -96.64, -90.14),
+    "Kansas": (36.99, 40.00, -102.05, -94.59), "Kentucky": (36.50, 39.15, -89.57, -81.96),
+    "Louisiana": (28.93, 33.02, -94.04, -88.82), "Maine": (43.06, 47.46, -71.08, -66.95),
+    "Maryland": (37.91, 39.72, -79.49, -75.05), "Massachusetts": (41.24, 42.89, -73.51, -69.93),
+    "Michigan": (41.70, 48.31, -90.42, -82.41), "Minnesota": (43.50, 49.38, -97.24, -89.49),
+    "Mississippi": (30.17, 35.00, -91.66, -88.10), "Missouri": (35.99, 40.61, -95.77, -89.10),
+    "Montana": (44.36, 49.00, -116.05, -104.04), "Nebraska": (40.00, 43.00, -104.05, -95.31),
+    "Nevada": (35.00, 42.00, -120.01, -114.04), "New Hampshire": (42.70, 45.31, -72.56, -70.61),
+    "New Jersey": (38.93, 41.36, -75.56, -73.89), "New Mexico": (31.33, 37.00, -109.05, -103.00),
+    "New York": (40.50, 45.02, -79.76, -71.86), "North Carolina": (33.84, 36.59, -84.32, -75.46),
+    "North Dakota": (45.94, 49.00, -104.05, -96.55), "Ohio": (38.40, 41.98, -84.82, -80.52),
+    "Oklahoma": (33.62, 37.00, -103.00, -94.43), "Oregon": (41.99, 46.29, -124.57, -116.46),
+    "Pennsylvania": (39.72, 42.27, -80.52, -74.69), "Rhode Island": (41.15, 42.02, -71.91, -71.12),
+    "South Carolina": (32.03, 35.22, -83.35, -78.54), "South Dakota": (42.48, 45.95, -104.06, -96.44),
+    "Tennessee": (34.98, 36.68, -90.31, -81.65), "Texas": (25.84, 36.50, -106.65, -93.51),
+    "Utah": (37.00, 42.00, -114.05, -109.04), "Vermont": (42.73, 45.02, -73.44, -71.46),
+    "Virginia": (36.54, 39.47, -83.68, -75.24), "Washington": (45.54, 49.00, -124.85, -116.92),
+    "West Virginia": (37.20, 40.64, -82.64, -77.72), "Wisconsin": (42.49, 47.31, -92.89, -86.25),
+    "Wyoming": (40.99, 45.01, -111.06, -104.05), "Puerto Rico": (17.88, 18.52, -67.95, -65.22)
+}
+STATE_BOUNDS_MARGIN = 0.1  # Degrees of slack around each state's bounding box
+CITY_OUTLIER_KM = 50  # Entries this far from the median of their city are flagged
+CITY_OUTLIER_MIN_ENTRIES = 3  # Entries are only checked against at least this many others in the same city
+DUPLICATE_DISTANCE_KM = 1  # Entries on the same day within this distance are flagged as possible duplicates
+# Header names each field can have in a GVA CSV export, compared case-insensitively
+CSV_COLUMNS = {
+    "date": ["Incident Date"],
+    "state": ["State"],
+    "city": ["City Or County"],
+    "street": ["Address"],
+    "killed": ["# Killed", "Victims Killed"],
+    "injured": ["# Injured", "Victims Injured"]
+}
+CSV_DATE_FORMATS = ["%B %d, %Y", "%Y-%m-%d", "%m/%d/%Y"]
+STREAM_CHUNK_SIZE = 500  # Rows written to the store at a time when streaming
+STREAM_PROGRESS_FILE = "{name}_progress.json"
@@ -0,0 +1,171 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+from constants import GAZETTEER_FILE, STATE_NAMES
+import csv
+from matching import normalize_place, place_names
+import mmap
+import os
+import re
+import struct
+
+MAGIC = b"GAZ1"
+HEADER = struct.Struct("<4sI")  # Magic, number of records
+RECORD = struct.Struct("<IHxxii")  # Key offset and length, latitude and longitude in ten-thousandths of a degree
+# Census gazetteer names end with what kind of place they are, as in "Aurora city" or "Nashville-Davidson metropolitan
+# government (balance)". Places people name with the descriptor are also indexed under their full name.
+DESCRIPTOR_REGEX = re.compile(r"\s+(?P<descriptor>city and borough|city|town|village|borough|municipality|CDP|"
+                              r"comunidad|zona urbana|urban county|corporation|(?:metropolitan|metro|unified|consolidated) "
+                              r"government|township|plantation|county|parish)(?: \(balance\))?$", flags=re.IGNORECASE)
+FULL_NAME_DESCRIPTORS = {"township", "county", "parish", "borough"}
+# When two places in a state have the same name, prefer incorporated places, then census-designated places, then
+# townships and counties
+PRIORITIES = {"cdp": 1, "comunidad": 1, "zona urbana": 1, "township": 0, "plantation": 0, "county": 0, "parish": 0}
+
+
+def place_key(city, state):
+    return "{}|{}".format(normalize_place(city), normalize_place(state)).encode("utf-8")
+
+
+def read_places(path, encoding="utf-8"):
+    """Read a Census Bureau gazetteer file (places, counties, or county subdivisions), yielding the names each place
+    can be looked up by, along with its state, coordinates, and priority."""
+    with open(path, newline="", encoding=encoding) as gazetteer_file:
+        reader = csv.reader(gazetteer_file, delimiter="\t")
+        columns = [column.strip() for column in next(reader)]
+        for row in reader:
+            place = dict(zip(columns, (value.strip() for value in row)))
+            state = STATE_NAMES.get(place["USPS"])
+            if not state:
+                continue
+            name = place["NAME"]
+            names = [name]
+            priority = 2
+            match = DESCRIPTOR_REGEX.search(name)
+            if match:
+                descriptor = match.group("descriptor").lower()
+                names = [name[:match.start()]]
+                if descriptor in FULL_NAME_DESCRIPTORS:
+                    names.append(name)
+                if name.endswith("(balance)") or descriptor.endswith(("government", "urban county")):
+                    # "Nashville-Davidson" and "Lexington-Fayette" also go by the city's own name
+                    names.append(re.split(r"[-/]", names[0])[0])
+                priority = PRIORITIES.get(descriptor, 2)
+            yield names, state, float(place["INTPTLAT"]), float(place["INTPTLONG"]), priority, int(place["ALAND"] or 0)
+
+
+def compile_gazetteer(sources, path=GAZETTEER_FILE, encoding="utf-8"):
+    """Compile gazetteer files into a sorted index of "city|state" keys that Gazetteer can binary search in place."""
+    best = {}
+    for source in sources:
+        for names, state, lat, lon, priority, area in read_places(source, encoding):
+            for name in names:
+                key = place_key(name, state)
+                if key not in best or (priority, area) > best[key][0]:
+                    best[key] = ((priority, area), round(lat * 10000), round(lon * 10000))
+    keys = sorted(best)
+    records = []
+    offset = 0
+    for key in keys:
+        records.append(RECORD.pack(offset, len(key), best[key][1], best[key][2]))
+        offset += len(key)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as index_file:
+        index_file.write(HEADER.pack(MAGIC, len(keys)))
+        index_file.write(b"".join(records))
+        index_file.write(b"".join(keys))
+    os.replace(tmp_path, path)
+    return len(keys)
+
+
+class Gazetteer:
+    """Looks up city-level coordinates in a compiled gazetteer index. The index is memory-mapped and binary searched
+    in place, so opening it is instant and lookups don't touch the network."""
+
+    def __init__(self, path=GAZETTEER_FILE):
+        self.file = open(path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise Exception("{} isn't a compiled gazetteer. Run 'python gazetteer.py compile' first.".format(path))
+        self.keys_offset = HEADER.size + self.count * RECORD.size
+
+    def record(self, number):
+        key_offset, key_length, lat, lon = RECORD.unpack_from(self.mmap, HEADER.size + number * RECORD.size)
+        start = self.keys_offset + key_offset
+        return self.mmap[start:start + key_length], lat, lon
+
+    def find(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            middle_key, lat, lon = self.record(middle)
+            if middle_key == key:
+                return {"lat": lat / 10000, "lon": lon / 10000}
+            if middle_key < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def lookup(self, city, state):
+        """Return the coordinates of a city, or None if it isn't in the gazetteer. For names like "Littleton (Highlands
+        Ranch)", the place in parentheses is more specific, so it's tried first."""
+        names = place_names(city)
+        for name in names[1:] + names[:1]:
+            coords = self.find(place_key(name, state))
+            if coords:
+                return coords
+        return None
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+
+def open_gazetteer(path=GAZETTEER_FILE):
+    """Open the compiled gazetteer, or return None if there isn't one."""
+    return Gazetteer(path) if os.path.exists(path) else None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", help="'compile' or 'lookup'")
+    parser.add_argument("args", nargs="+", help="gazetteer files to compile, or the city and state to look up")
+    parser.add_argument("-o", "--output", help="compiled index", default=GAZETTEER_FILE)
+    parser.add_argument("-e", "--encoding", help="encoding of the gazetteer files", default="utf-8")
+    args = parser.parse_args()
+    if args.action not in ["compile", "lookup"]:
+        raise Exception("Unrecognized action {}. Expected either 'compile' or 'lookup'.".format(args.action))
+    return args
+
+
+def main():
+    args = parse_arguments()
+    if args.action == "compile":
+        count = compile_gazetteer(args.args, args.output, args.encoding)
+        print("Wrote {} places to {}.".format(count, args.output))
+    else:
+        [city, state] = args.args
+        gazetteer = Gazetteer(args.output)
+        print(gazetteer.lookup(city, state))
+        gazetteer.close()
+
+
+if __name__ == "__main__":
+    main()
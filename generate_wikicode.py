@@ -16,61 +16,293 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import argparse
-from constants import COMMENT, TEMPLATE, API_URL, EMPTY_TEMPLATE, YEAR, TABLE_ENTRY_TEMPLATE
+from citations import name_refs
+from collections import Counter
+from constants import (COMMENT, TEMPLATE, API_URL, EMPTY_TEMPLATE, YEAR, TABLE_ENTRY_TEMPLATE, RENDER_CACHE_FILE,
+                       DIFF_FILE, CLUSTER_TEMPLATE, CLUSTER_COMMENT, CLUSTER_GRID, CLUSTER_MIN_MARKSIZE,
+                       CLUSTER_MAX_MARKSIZE, CLUSTER_COMMENT_PLACES, CLUSTERED_MAP_FILE, GEOJSON_FILE)
 from datetime import datetime
+from functools import lru_cache
+import hashlib
+import instrumentation
+from instrumentation import metrics
 import json
+import math
+from storage import open_store, write_json_atomic
 
+# Changing any template changes every entry's rendering, so they're part of every entry's hash
+TEMPLATES_HASH = hashlib.sha1("".join([COMMENT, TEMPLATE, API_URL, EMPTY_TEMPLATE, TABLE_ENTRY_TEMPLATE])
+                              .encode("utf-8")).hexdigest()
 
-def parse_arguments():
+
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument("format", help="'table', 'map', or 'both'")
-    args = parser.parse_args()
-    if args.format not in ['table', 'map', 'both']:
-        raise Exception("Unrecognized action {}. Expected one of 'table', 'map', or 'both'.".format(args.action))
+    parser.add_argument("format", help="'table', 'map', 'both', 'clustered', or 'geojson'")
+    parser.add_argument("-y", "--year", help="year of the dataset to render", default=YEAR)
+    parser.add_argument("--full", help="ignore the render cache and render every entry", action="store_true")
+    parser.add_argument("--grid", help="degrees of latitude and longitude covered by each cell of the clustered map",
+                        type=float, default=CLUSTER_GRID)
+    parser.add_argument("--profile", help="profile the run with cProfile", action="store_true")
+    args = parser.parse_args(argv)
+    check_format(args.format)
+    if args.grid <= 0:
+        raise Exception("Grid size must be positive, got {}.".format(args.grid))
     return args
 
 
+def check_format(fmt):
+    if fmt not in ['table', 'map', 'both', 'clustered', 'geojson']:
+        raise Exception("Unrecognized format {}. Expected one of 'table', 'map', 'both', 'clustered', or "
+                        "'geojson'.".format(fmt))
+
+
+@lru_cache(maxsize=None)
+def format_date(ymd):
+    """Turn a YYYYMMDD date into the "Month D, YYYY" format used in the wikicode."""
+    return datetime.strptime(ymd, "%Y%m%d").strftime("%B %-d, %Y")
+
+
+def render_map_coords(shooting):
+    """Render coordinates in a format that can be pasted into the {{Location map+}} Wikipedia map template. If the
+    script was run without the interactive flag, this output will need to be manually checked for missing coordinate
+    values."""
+    comment = COMMENT.format(city=shooting.city, state=shooting.state, date=format_date(shooting.date))
+    if shooting.lat and shooting.lon:
+        return TEMPLATE.format(lon=shooting.lon, lat=shooting.lat) + comment + "\n"
+    api_url = API_URL.format(street=shooting.street, city=shooting.city, state=shooting.state, format="html")
+    return EMPTY_TEMPLATE + comment + " # COULD NOT FIND COORDINATES FOR {}, {}, {}: {}\n".format(shooting.street, shooting.city, shooting.state, api_url)
+
+
+def render_table_entry(shooting):
+    """Render a shooting in a format that can be pasted into a wikitable."""
+    loc = "{}, {}".format(shooting.city, shooting.state)
+    if shooting.wikilink_target:
+        loc = shooting.wikilink_target + loc
+    return TABLE_ENTRY_TEMPLATE.format(date=format_date(shooting.date), location=loc, killed=shooting.killed, injured=shooting.injured, total=shooting.total, desc=shooting.description if shooting.description else '', refs="".join(shooting.refs))
+
+
 def write_map_coords(outfile, shooting):
     """Write coordinates to the output file, in a format that can be pasted into the {{Location map+}} Wikipedia
-    map template. If the script was run without the interactive flag, this output file will need to be manually checked
-    for missing coordinate values."""
-    dtime = datetime.strptime(shooting["date"], "%Y%m%d")
-    mdy = dtime.strftime("%B %-d, %Y")
-    comment = COMMENT.format(city=shooting["city"], state=shooting["state"], date=mdy)
-    if shooting["lat"] and shooting["lon"]:
-        outfile.write(TEMPLATE.format(lon=shooting["lon"], lat=shooting["lat"]) + comment + "\n")
-    else:
-        api_url = API_URL.format(street=shooting["street"], city=shooting["city"], state=shooting["state"], format="html")
-        outfile.write(EMPTY_TEMPLATE + comment + " # COULD NOT FIND COORDINATES FOR {}, {}, {}: {}\n".format(shooting["street"], shooting["city"], shooting["state"], api_url))
+    map template."""
+    outfile.write(render_map_coords(shooting))
 
 
 def write_table_entry(outfile, shooting):
-    """Write shootings to the output file, in a format that can be pasted into a wikitable. If the script was run
-    without the interactive flag, this output file will need to be manually checked for missing coordinate values."""
-    dtime = datetime.strptime(shooting["date"], "%Y%m%d")
-    mdy = dtime.strftime("%B %-d, %Y")
-    loc = "{}, {}".format(shooting["city"], shooting["state"])
-    if shooting["wikilink_target"]:
-        loc = shooting["wikilink_target"] + loc
-    entry = TABLE_ENTRY_TEMPLATE.format(date=mdy, location=loc, killed=shooting["killed"], injured=shooting["injured"], total=shooting["total"], desc=shooting["description"] if shooting["description"] else '', refs="".join(shooting["refs"]))
-    outfile.write(entry)
-
-
-def main():
-    args = parse_arguments()
-    with open(YEAR + ".json", encoding="utf-8") as shootings_json_file, \
-        open(YEAR + "_map.txt", "w", encoding="utf-8") as map_file, \
-        open(YEAR + "_table.txt", "w", encoding="utf-8") as table_file:
-        shootings_dict = json.load(shootings_json_file)
-        keys = list(shootings_dict.keys())
-        keys.sort(key=lambda x:x.split("_")[0], reverse=True)
-        for key in keys:
-            shooting = shootings_dict[key]
-            if args.format in ['map', 'both']:
-                write_map_coords(map_file, shooting)
-            if args.format in ['table', 'both']:
-                write_table_entry(table_file, shooting)
+    """Write shootings to the output file, in a format that can be pasted into a wikitable."""
+    outfile.write(render_table_entry(shooting))
+
+
+def cluster(shootings_dict, grid=CLUSTER_GRID):
+    """Bin the entries that have coordinates into cells of `grid` degrees. Returns one cluster per non-empty cell,
+    positioned at the mean of its entries' coordinates."""
+    cells = {}
+    for shooting in shootings_dict.values():
+        if not (shooting.lat and shooting.lon):
+            continue
+        key = (math.floor(shooting.lat / grid), math.floor(shooting.lon / grid))
+        if key not in cells:
+            cells[key] = {"count": 0, "killed": 0, "injured": 0, "total": 0, "lat": 0.0, "lon": 0.0,
+                          "places": Counter()}
+        cell = cells[key]
+        cell["count"] += 1
+        cell["killed"] += shooting.killed
+        cell["injured"] += shooting.injured
+        cell["total"] += shooting.total
+        cell["lat"] += shooting.lat
+        cell["lon"] += shooting.lon
+        cell["places"]["{}, {}".format(shooting.city, shooting.state)] += 1
+    clusters = list(cells.values())
+    for cell in clusters:
+        cell["lat"] = round(cell["lat"] / cell["count"], 4)
+        cell["lon"] = round(cell["lon"] / cell["count"], 4)
+    return clusters
+
+
+def marker_size(total, most):
+    """Scale the marker so its area, rather than its width, grows with the number of victims."""
+    if not most:
+        return CLUSTER_MIN_MARKSIZE
+    return round(CLUSTER_MIN_MARKSIZE + (CLUSTER_MAX_MARKSIZE - CLUSTER_MIN_MARKSIZE) * math.sqrt(total / most))
+
+
+def render_clustered_map(clusters):
+    """Render one {{Location map+}} marker per cluster. Larger clusters come first so smaller markers are drawn on top
+    of them."""
+    most = max((cell["total"] for cell in clusters), default=0)
+    lines = []
+    for cell in sorted(clusters, key=lambda x: (-x["total"], -x["count"], x["lat"], x["lon"])):
+        places = "; ".join(place for place, _ in cell["places"].most_common(CLUSTER_COMMENT_PLACES))
+        if len(cell["places"]) > CLUSTER_COMMENT_PLACES:
+            places += "; ..."
+        lines.append(CLUSTER_TEMPLATE.format(size=marker_size(cell["total"], most), lat=cell["lat"], lon=cell["lon"]) +
+                     CLUSTER_COMMENT.format(count=cell["count"], killed=cell["killed"], injured=cell["injured"],
+                                            places=places) + "\n")
+    return "".join(lines)
+
+
+def write_clustered_map(path, shootings_dict, grid=CLUSTER_GRID):
+    clusters = cluster(shootings_dict, grid)
+    with open(path, "w", encoding="utf-8") as map_file:
+        map_file.write(render_clustered_map(clusters))
+    print("Wrote {} markers for {} entries to {}.".format(len(clusters), len(shootings_dict), path))
+
+
+def to_feature(shooting_id, shooting):
+    """Turn an entry into a GeoJSON Point feature. GeoJSON puts longitude before latitude."""
+    return {
+        "type": "Feature",
+        "id": shooting_id,
+        "geometry": {"type": "Point", "coordinates": [shooting.lon, shooting.lat]},
+        "properties": {
+            "date": "{}-{}-{}".format(shooting.date[:4], shooting.date[4:6], shooting.date[6:]),
+            "city": shooting.city,
+            "state": shooting.state,
+            "street": shooting.street,
+            "killed": shooting.killed,
+            "injured": shooting.injured,
+            "total": shooting.total,
+            "article": shooting.wikilink_target.rstrip("|") if shooting.wikilink_target else None
+        }
+    }
+
+
+def write_geojson(path, shootings_dict):
+    """Write the entries that have coordinates as a GeoJSON FeatureCollection, newest first."""
+    keys = sorted(shootings_dict.keys(), key=lambda x: shootings_dict[x].date, reverse=True)
+    features = [to_feature(key, shootings_dict[key]) for key in keys
+                if shootings_dict[key].lat and shootings_dict[key].lon]
+    write_json_atomic(path, {"type": "FeatureCollection", "features": features}, indent=None)
+    print("Wrote {} features to {}. {} entries without coordinates were left out.".format(
+        len(features), path, len(shootings_dict) - len(features)))
+
+
+def entry_hash(shooting):
+    return hashlib.sha1((TEMPLATES_HASH + json.dumps(shooting.to_dict(), sort_keys=True)).encode("utf-8")).hexdigest()
+
+
+def load_render_cache(path):
+    try:
+        with open(path, encoding="utf-8") as cache_file:
+            return json.load(cache_file)
+    except FileNotFoundError:
+        return None
+
+
+def render(shootings_dict, cache):
+    """Render every entry, reusing the cached rendering of any entry that hasn't changed. Returns the new cache and
+    the IDs of the entries that were added or changed."""
+    rendered = {}
+    changed = []
+    for shooting_id, shooting in shootings_dict.items():
+        shooting_hash = entry_hash(shooting)
+        cached = cache.get(shooting_id)
+        if cached and cached["hash"] == shooting_hash:
+            rendered[shooting_id] = cached
+        else:
+            rendered[shooting_id] = {"hash": shooting_hash, "table": render_table_entry(shooting),
+                                     "map": render_map_coords(shooting)}
+            changed.append(shooting_id)
+    metrics.increment("render_cache_hits", len(rendered) - len(changed))
+    metrics.increment("render_cache_misses", len(changed))
+    return rendered, changed
+
+
+def table_output(entry):
+    """An entry's row as it appears in the table, with its refs named. Caches written before refs were named only
+    have the row as rendered."""
+    return entry.get("output", entry["table"])
+
+
+def write_diff(path, old_cache, rendered, changed):
+    """Write the added, changed, and removed rows, so small edits can be made to the article instead of replacing the
+    whole table. Rows are written as they appear in the table, so a row that now holds (or no longer holds) the
+    definition of a named ref shows up as changed."""
+    removed = sorted(set(old_cache) - set(rendered))
+    with open(path, "w", encoding="utf-8") as diff_file:
+        for shooting_id in sorted(changed, reverse=True):
+            old_entry, entry = old_cache.get(shooting_id), rendered[shooting_id]
+            if old_entry:
+                diff_file.write("Changed {}:\n".format(shooting_id))
+                for old, new in [(old_entry["map"], entry["map"]), (table_output(old_entry), table_output(entry))]:
+                    if old != new:
+                        diff_file.write("- {}+ {}".format(old, new))
+                diff_file.write("\n")
+            else:
+                diff_file.write("Added {}:\n+ {}+ {}\n".format(shooting_id, entry["map"], table_output(entry)))
+        for shooting_id in removed:
+            diff_file.write("Removed {}:\n- {}- {}\n".format(shooting_id, old_cache[shooting_id]["map"],
+                                                             table_output(old_cache[shooting_id])))
+    print("{} added, {} changed, {} removed. Wrote changes to {}.".format(
+        len([x for x in changed if x not in old_cache]), len([x for x in changed if x in old_cache]), len(removed),
+        path))
+
+
+def main(argv=None, store=None):
+    args = parse_arguments(argv)
+    with instrumentation.run("generate_wikicode", args.year, profile=args.profile):
+        generate(args, store)
+
+
+def generate(args, store=None):
+    """Load the year's entries from the store and write the requested outputs."""
+    owns_store = store is None
+    if owns_store:
+        store = open_store()
+    with metrics.stage("load"):
+        shootings_dict = store.load(args.year)
+    if owns_store:
+        store.close()
+    write_outputs(shootings_dict, args.year, args.format, args.full, args.grid)
+
+
+def output_paths(year, fmt):
+    """The files write_outputs writes for a format."""
+    if fmt == 'clustered':
+        return [CLUSTERED_MAP_FILE.format(year=year)]
+    if fmt == 'geojson':
+        return [GEOJSON_FILE.format(year=year)]
+    return [year + "_" + output + ".txt" for output in ['map', 'table'] if fmt in [output, 'both']]
+
+
+def write_outputs(shootings_dict, year, fmt, full=False, grid=CLUSTER_GRID):
+    """Render the entries and write the map and/or table, along with the diff against the last run. The clustered map
+    and GeoJSON are generated straight from the entries, so they skip the render cache and diff."""
+    if fmt in ['clustered', 'geojson']:
+        with metrics.stage("write") as write_stage:
+            write_stage["rows"] = len(shootings_dict)
+            if fmt == 'clustered':
+                write_clustered_map(CLUSTERED_MAP_FILE.format(year=year), shootings_dict, grid)
+            else:
+                write_geojson(GEOJSON_FILE.format(year=year), shootings_dict)
+        return
+
+    cache_path = RENDER_CACHE_FILE.format(year=year)
+    with metrics.stage("render") as render_stage:
+        old_cache = None if full else load_render_cache(cache_path)
+        rendered, changed = render(shootings_dict, old_cache or {})
+        render_stage["rows"] = len(rendered)
+
+    # Newest first. Entries on the same day stay in ID order.
+    keys = sorted(shootings_dict.keys(), key=lambda x: shootings_dict[x].date, reverse=True)
+    # Citations used by more than one entry are defined once and reused by name. Which row holds the definition depends
+    # on the rows around it, so this is redone on every run, and rows whose refs changed count as changed in the diff.
+    changed = set(changed)
+    for key, output in zip(keys, name_refs([rendered[key]["table"] for key in keys])):
+        rendered[key] = dict(rendered[key], output=output)
+        if old_cache and key in old_cache and table_output(old_cache[key]) != output:
+            changed.add(key)
+    with metrics.stage("write"):
+        if fmt in ['map', 'both']:
+            with open(year + "_map.txt", "w", encoding="utf-8") as map_file:
+                map_file.write("".join(rendered[key]["map"] for key in keys))
+        if fmt in ['table', 'both']:
+            with open(year + "_table.txt", "w", encoding="utf-8") as table_file:
+                table_file.write("".join(rendered[key]["output"] for key in keys))
+
+        if old_cache is not None:
+            write_diff(DIFF_FILE.format(year=year), old_cache, rendered, changed)
+        write_json_atomic(cache_path, rendered)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
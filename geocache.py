@@ -0,0 +1,92 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from constants import GEOCODE_CACHE_FILE, GEOCODE_CACHE_TTL, GEOCODE_NEGATIVE_CACHE_TTL, GEOCODE_CACHE_MAX_ENTRIES
+import re
+import sqlite3
+import threading
+import time
+
+
+def normalize_query(street, city, state):
+    """Normalize a street/city/state lookup into the string used as the cache key, so trivially different spellings of
+    the same query ("5000 block of Main St." vs. "5000  main st.") share an entry."""
+    parts = []
+    for part in [street, re.sub(r"\(.*?\)", "", city or ""), state]:
+        part = (part or "").lower().replace(" block of", "")
+        parts.append(" ".join(part.split()))
+    return "|".join(parts)
+
+
+class GeocodeCache:
+    """Persistent SQLite cache of OSM lookups. Lookups that found no single result are cached too, with a shorter TTL,
+    so hopeless queries aren't retried on every run. Entries are evicted when they outlive their TTL, and the least
+    recently used entries are dropped once the cache grows past max_entries. The cache can be shared between threads."""
+
+    def __init__(self, path=GEOCODE_CACHE_FILE, ttl=GEOCODE_CACHE_TTL, negative_ttl=GEOCODE_NEGATIVE_CACHE_TTL,
+                 max_entries=GEOCODE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS geocodes (query TEXT PRIMARY KEY, lat TEXT, lon TEXT, "
+                          "created REAL NOT NULL, last_used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS geocodes_last_used ON geocodes (last_used)")
+        self.evict()
+
+    def get(self, street, city, state):
+        """Return a (found, coords) tuple. A cached negative result is (True, None)."""
+        query = normalize_query(street, city, state)
+        with self.lock:
+            row = self.conn.execute("SELECT lat, lon, created FROM geocodes WHERE query = ?", (query,)).fetchone()
+            if not row:
+                return False, None
+            lat, lon, created = row
+            now = time.time()
+            if now - created > (self.ttl if lat is not None else self.negative_ttl):
+                return False, None
+            self.conn.execute("UPDATE geocodes SET last_used = ? WHERE query = ?", (now, query))
+            self.conn.commit()
+        if lat is None:
+            return True, None
+        return True, {"lat": lat, "lon": lon}
+
+    def set(self, street, city, state, coords):
+        """Store the result of a lookup. Pass coords=None to record that the lookup found no single result."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO geocodes (query, lat, lon, created, last_used) "
+                              "VALUES (?, ?, ?, ?, ?)", (normalize_query(street, city, state),
+                                                         coords["lat"] if coords else None,
+                                                         coords["lon"] if coords else None, now, now))
+            self.conn.commit()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used entries beyond max_entries."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("DELETE FROM geocodes WHERE (lat IS NOT NULL AND created < ?) "
+                              "OR (lat IS NULL AND created < ?)", (now - self.ttl, now - self.negative_ttl))
+            self.conn.execute("DELETE FROM geocodes WHERE query IN (SELECT query FROM geocodes "
+                              "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self.conn.commit()
+
+    def close(self):
+        self.evict()
+        self.conn.close()
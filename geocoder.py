@@ -0,0 +1,246 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from constants import (API_URL, NOMINATIM_ENDPOINT, REQUEST_HEADERS, GEOCODE_RATE, GEOCODE_BURST, GEOCODE_WORKERS,
+                       GEOCODE_MAX_RETRIES, GEOCODE_BACKOFF, GEOCODE_TIMEOUT)
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from instrumentation import metrics
+import json
+import multiprocessing
+import re
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket. Each request takes one token; tokens refill at `rate` per second up to `capacity`.
+    Passing the state from shared_state() lets buckets in several processes draw from the same tokens."""
+
+    def __init__(self, rate=GEOCODE_RATE, capacity=GEOCODE_BURST, shared=None):
+        self.rate = rate
+        self.capacity = capacity
+        if shared is None:
+            shared = _LockedState([capacity, time.monotonic()], threading.Lock())
+        self.state = shared
+
+    @staticmethod
+    def shared_state(capacity=GEOCODE_BURST):
+        """Create bucket state in shared memory, so it can be handed to worker processes."""
+        return multiprocessing.Array("d", [capacity, time.monotonic()])
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.state.get_lock():
+                now = time.monotonic()
+                tokens = min(self.capacity, self.state[0] + (now - self.state[1]) * self.rate)
+                self.state[1] = now
+                if tokens >= 1:
+                    self.state[0] = tokens - 1
+                    return
+                self.state[0] = tokens
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+            metrics.add_duration("throttle_wait", wait)
+
+
+class _LockedState(list):
+    """In-process stand-in for a multiprocessing.Array, pairing the bucket state with a thread lock."""
+
+    def __init__(self, state, lock):
+        super().__init__(state)
+        self.lock = lock
+
+    def get_lock(self):
+        return self.lock
+
+
+def parse_response(resp):
+    """Return coordinates if OSM found exactly one result, otherwise None."""
+    results = json.loads(resp.text)
+    if len(results) == 1:
+        return {"lat": results[0]["lat"], "lon": results[0]["lon"]}
+    return None
+
+
+def parse_retry_after(value):
+    """Turn a Retry-After header, either a number of seconds or an HTTP date, into seconds to wait. Returns None if
+    there's no usable value."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class Geocoder:
+    """Looks up coordinates from a Nominatim-compatible endpoint. All requests go through one pooled HTTP session and
+    one token bucket, so any number of worker threads can share a geocoder without breaking the rate limit. 429 and
+    5xx responses are retried with exponential backoff. If there's a gazetteer, city-level lookups are answered from it
+    first, so only street addresses and places missing from the gazetteer need a request."""
+
+    def __init__(self, endpoint=NOMINATIM_ENDPOINT, rate=GEOCODE_RATE, burst=GEOCODE_BURST, cache=None,
+                 max_retries=GEOCODE_MAX_RETRIES, backoff=GEOCODE_BACKOFF, timeout=GEOCODE_TIMEOUT,
+                 pool_size=GEOCODE_WORKERS, bucket=None, gazetteer=None):
+        self.endpoint = endpoint
+        self.gazetteer = gazetteer
+        self.bucket = bucket or TokenBucket(rate, burst)
+        self.cache = cache
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(REQUEST_HEADERS)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, params):
+        """Make one rate-limited request, retrying on rate limiting, server errors, and connection failures."""
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            delay = self.backoff * 2 ** attempt
+            if attempt:
+                metrics.increment("http_retries")
+            start = time.perf_counter()
+            try:
+                resp = self.session.get(self.endpoint, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                metrics.increment("http_connection_errors")
+                if attempt == self.max_retries:
+                    raise
+                self.back_off(delay)
+                continue
+            finally:
+                metrics.observe_latency(time.perf_counter() - start)
+            if resp.status_code != 429 and resp.status_code < 500:
+                return resp
+            metrics.increment("http_429" if resp.status_code == 429 else "http_5xx")
+            if attempt == self.max_retries:
+                if resp.status_code == 429:
+                    raise Exception("OSM has rate-limited you, even after {} retries.".format(self.max_retries))
+                raise Exception("OSM request failed with status {}.".format(resp.status_code))
+            retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+            self.back_off(delay if retry_after is None else retry_after)
+
+    @staticmethod
+    def back_off(seconds):
+        time.sleep(seconds)
+        metrics.add_duration("backoff_wait", seconds)
+
+    def lookup(self, street, city, state):
+        """Look up a single street/city/state query, using the cache if there is one."""
+        if self.cache:
+            found, coords = self.cache.get(street, city, state)
+            if found:
+                metrics.increment("cache_hits")
+                if coords is None:
+                    metrics.increment("cache_negative_hits")
+                return coords
+            metrics.increment("cache_misses")
+        resp = self.request({"street": street or "", "city": re.sub(r"\(.*?\)", "", city), "state": state,
+                             "format": "json"})
+        coords = parse_response(resp)
+        if self.cache:
+            self.cache.set(street, city, state, coords)
+        return coords
+
+    def geocode(self, street, city, state):
+        """Look up coordinates with the street address, falling back to the city alone if that doesn't find a single
+        result. Returns None if neither lookup worked."""
+        if street:
+            # A lot of these locations are written as "5000 block of X St.", which confuses OSM.
+            # Changing it to "5000 X St." helps OSM while remaining plenty precise.
+            coords = self.lookup(street.replace(" block of", ""), city, state)
+            if coords:
+                metrics.increment("geocode_first_try")
+                return coords
+            coords = self.locate_city(city, state)
+            metrics.increment("geocode_fallback" if coords else "geocode_unresolved")
+            return coords
+        coords = self.locate_city(city, state)
+        metrics.increment("geocode_first_try" if coords else "geocode_unresolved")
+        return coords
+
+    def locate_city(self, city, state):
+        """Look up a city alone, in the gazetteer if there is one, before asking the endpoint."""
+        if self.gazetteer:
+            coords = self.gazetteer.lookup(city, state)
+            if coords:
+                metrics.increment("gazetteer_hits")
+                return coords
+            metrics.increment("gazetteer_misses")
+        return self.lookup("", city, state)
+
+    def close(self):
+        self.session.close()
+        if self.cache:
+            self.cache.close()
+        if self.gazetteer:
+            self.gazetteer.close()
+
+
+def prompt_coords(street, city, state):
+    """Prompt the user to input coordinates that couldn't be found using OpenStreetMap."""
+    api_url = API_URL.format(street=street if street else "", city=city, state=state, format="html")
+    print("Find coordinates for {}, {}, {}: {}. Rounding will be done automatically.".format(street, city, state, api_url))
+    while True:
+        latlon = input("lat,lon: ")
+        try:
+            [lat, lon] = latlon.split(",")
+            return {"lat": lat.strip(), "lon": lon.strip()}
+        except ValueError:
+            print("Invalid input. Please enter comma-separated latitude and longitude.")
+
+
+def get_coords(street, city, state, interactive=False, geocoder=None):
+    """Attempt to look up coordinates of the shooting using OpenStreetMap. If the script is run with the interactive
+    flag, the user will be prompted to enter coordinates if the location can't be found. Otherwise, the empty value
+    is written to the outfile with a comment indicating it needs to be updated."""
+    if geocoder:
+        coords = geocoder.geocode(street, city, state)
+    else:
+        geocoder = Geocoder()
+        try:
+            coords = geocoder.geocode(street, city, state)
+        finally:
+            geocoder.close()
+    if coords:
+        return coords
+
+    # If this still didn't work we'll need to do this manually
+    if interactive:
+        metrics.increment("geocode_prompted")
+        return prompt_coords(street, city, state)
+    return None
+
+
+def round_coords(coords):
+    """Round lat/lon to 4 decimal points -- OSM often returns artificially precise values"""
+    if coords:
+        return {"lat": round(float(coords["lat"]), 4), "lon": round(float(coords["lon"]), 4)}
+    return None
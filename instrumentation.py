@@ -0,0 +1,168 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from bisect import bisect_left
+from collections import Counter
+from constants import RUN_REPORT_FILE, PROFILE_FILE, LATENCY_BUCKETS
+import contextlib
+import cProfile
+from datetime import datetime
+import io
+import pstats
+from storage import write_json_atomic
+import threading
+import time
+
+
+class Metrics:
+    """Counters, accumulated durations, stage timings, and an HTTP latency histogram for one run of a script. Safe to
+    update from several threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = Counter()
+            self.durations = Counter()
+            self.stages = {}
+            self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def increment(self, name, count=1):
+        with self.lock:
+            self.counters[name] += count
+
+    def add_duration(self, name, seconds):
+        with self.lock:
+            self.durations[name] += seconds
+
+    def observe_latency(self, seconds):
+        with self.lock:
+            self.counters["http_requests"] += 1
+            self.durations["http_requests"] += seconds
+            self.latencies[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage of the run. The block can set stage["rows"] to report a throughput."""
+        stage = {"rows": None}
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.stages[name] = {"seconds": seconds, "rows": stage["rows"]}
+                if stage["rows"]:
+                    self.stages[name]["rows_per_second"] = stage["rows"] / seconds if seconds else None
+
+    def timed_iter(self, name, iterable):
+        """Yield from an iterable, adding the time spent producing each item to a duration."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_duration(name, time.perf_counter() - start)
+                return
+            self.add_duration(name, time.perf_counter() - start)
+            yield item
+
+    def report(self):
+        with self.lock:
+            return {
+                "stages": dict(self.stages),
+                "counters": dict(self.counters),
+                "durations": dict(self.durations),
+                "http_latency_histogram": [{"le": bound, "count": count}
+                                           for bound, count in zip(LATENCY_BUCKETS + [None], self.latencies)]
+            }
+
+
+metrics = Metrics()
+active_runs = []
+
+
+def summarize(report):
+    """Format a run report for people."""
+    lines = ["{} {} finished in {:.2f}s".format(report["script"], report["year"], report["seconds"])]
+    for name, stage in report["stages"].items():
+        line = "  {:<24} {:>9.3f}s".format(name, stage["seconds"])
+        if stage.get("rows_per_second"):
+            line += "  {:>8} rows  {:>10.1f} rows/s".format(stage["rows"], stage["rows_per_second"])
+        lines.append(line)
+    counters, durations = report["counters"], report["durations"]
+    if counters.get("http_requests"):
+        lines.append("  HTTP: {} requests, {:.3f}s average, {} rate-limited (429), {} server errors, {} retries"
+                     .format(counters["http_requests"], durations["http_requests"] / counters["http_requests"],
+                             counters.get("http_429", 0), counters.get("http_5xx", 0), counters.get("http_retries", 0)))
+        lines.append("  Waiting (summed over workers): {:.2f}s on the rate limit, {:.2f}s backing off".format(
+            durations.get("throttle_wait", 0), durations.get("backoff_wait", 0)))
+    if counters.get("cache_hits") or counters.get("cache_misses"):
+        lines.append("  Geocoding cache: {} hits ({} negative), {} misses".format(
+            counters.get("cache_hits", 0), counters.get("cache_negative_hits", 0), counters.get("cache_misses", 0)))
+    if counters.get("gazetteer_hits") or counters.get("gazetteer_misses"):
+        lines.append("  Gazetteer: {} hits, {} misses".format(counters.get("gazetteer_hits", 0),
+                                                           counters.get("gazetteer_misses", 0)))
+    if any(counters.get(x) for x in ["geocode_first_try", "geocode_fallback", "geocode_unresolved"]):
+        lines.append("  Geocoded: {} on the first try, {} by falling back to the city, {} unresolved ({} entered by hand)"
+                     .format(counters.get("geocode_first_try", 0), counters.get("geocode_fallback", 0),
+                             counters.get("geocode_unresolved", 0), counters.get("geocode_prompted", 0)))
+    for name, seconds in sorted(durations.items()):
+        if name not in ["http_requests", "throttle_wait", "backoff_wait"]:
+            lines.append("  {:<24} {:>9.3f}s".format(name, seconds))
+    for name, count in sorted(counters.items()):
+        if not name.startswith(("http_", "cache_", "gazetteer_", "geocode_")):
+            lines.append("  {:<24} {:>9}".format(name, count))
+    return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def run(script, year, profile=False):
+    """Instrument one run of a script: reset the metrics, optionally profile it with cProfile, and at the end write a
+    JSON report and print a summary. A run nested inside another (one script calling another's main in the same
+    process) is timed as a stage of the outer run instead."""
+    if active_runs:
+        with metrics.stage(script):
+            yield
+        return
+    metrics.reset()
+    active_runs.append(script)
+    profiler = cProfile.Profile() if profile else None
+    started = datetime.now()
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        active_runs.pop()
+        report = dict(metrics.report(), script=script, year=year, started=started.isoformat(timespec="seconds"),
+                      seconds=time.perf_counter() - start)
+        write_json_atomic(RUN_REPORT_FILE.format(year=year, script=script), report)
+        print(summarize(report))
+        if profiler:
+            profile_path = PROFILE_FILE.format(year=year, script=script)
+            profiler.dump_stats(profile_path)
+            stats = io.StringIO()
+            pstats.Stats(profiler, stream=stats).sort_stats("cumulative").print_stats(15)
+            print(stats.getvalue())
+            print("Wrote profile to {}.".format(profile_path))
@@ -0,0 +1,109 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from collections import defaultdict
+from constants import CITY_AUTO_MATCH_SCORE, CITY_LIKELY_MATCH_SCORE, CITY_NO_MATCH_SCORE
+from difflib import SequenceMatcher
+import re
+
+
+ABBREVIATIONS = {"st": "saint", "ste": "sainte", "ft": "fort", "mt": "mount", "twp": "township"}
+
+
+def normalize_place(name):
+    """Lowercase a city or state name and strip parentheticals, punctuation, and common abbreviations, so
+    "St. Louis (Wellston)" and "saint louis" compare equal."""
+    name = re.sub(r"[^a-z0-9 ]", " ", re.sub(r"\(.*?\)", "", name or "").lower())
+    return " ".join(ABBREVIATIONS.get(word, word) for word in name.split())
+
+
+def place_names(name):
+    """Return the normalized names a place goes by. GVA puts the neighborhood or suburb in parentheses, as in
+    "Littleton (Highlands Ranch)", and the wikitext may use either one."""
+    names = [normalize_place(name)]
+    names.extend(normalize_place(alias) for alias in re.findall(r"\((.*?)\)", name or ""))
+    return names
+
+
+def city_similarity(a, b):
+    """Score how alike two normalized city names are, from 0 to 1. Takes the better of the edit-distance ratio and the
+    share of tokens the names have in common, so "Philadelphia"/"Philadephia" scores well and "Fort Worth"/"Worth"
+    fairly well. A name that only contains the other, like "Chicago Heights" and "Chicago", is never close enough to
+    match without the victim counts agreeing."""
+    if a == b:
+        return 1.0
+    ratio = SequenceMatcher(None, a, b).ratio()
+    a_tokens, b_tokens = set(a.split()), set(b.split())
+    if not a_tokens or not b_tokens:
+        return ratio
+    overlap = len(a_tokens & b_tokens) / len(a_tokens | b_tokens)
+    return max(ratio, overlap * 0.9)
+
+
+class ShootingIndex:
+    """In-memory index over the loaded entries: date -> state -> IDs, and normalized city -> IDs. Used to find the
+    entries a wikitext row might refer to without scanning every key."""
+
+    def __init__(self, shootings_dict):
+        self.shootings_dict = shootings_dict
+        self.by_date = defaultdict(lambda: defaultdict(list))
+        self.by_city = defaultdict(list)
+        for shooting_id in shootings_dict:
+            self.add(shooting_id)
+
+    def add(self, shooting_id):
+        shooting = self.shootings_dict[shooting_id]
+        self.by_date[shooting.date][normalize_place(shooting.state)].append(shooting_id)
+        for name in place_names(shooting.city):
+            self.by_city[name].append(shooting_id)
+
+    def candidates(self, ymd, city, state):
+        """Return IDs of entries on the same date in the same state. If there are none (for example because the
+        state is written differently), fall back to entries on that date in a city with the same name."""
+        same_state = self.by_date.get(ymd, {}).get(normalize_place(state))
+        if same_state:
+            return same_state
+        return [x for x in self.by_city.get(normalize_place(city), []) if self.shootings_dict[x].date == ymd]
+
+    def rank(self, ymd, city, state, killed, injured):
+        """Return (score, ID, victims_match) tuples for the candidate entries, best match first."""
+        normalized_city = normalize_place(city)
+        ranked = []
+        for shooting_id in self.candidates(ymd, city, state):
+            shooting = self.shootings_dict[shooting_id]
+            score = max(city_similarity(normalized_city, name) for name in place_names(shooting.city))
+            victims_match = shooting.killed == killed and shooting.injured == injured
+            ranked.append((score, shooting_id, victims_match))
+        ranked.sort(key=lambda x: (x[0], x[2]), reverse=True)
+        return ranked
+
+
+def is_certain_match(ranked):
+    """The best candidate is certainly the same shooting if its city is nearly identical, or its city is fairly close
+    and the victim counts agree, and no other candidate is as good."""
+    if not ranked:
+        return False
+    score, _, victims_match = ranked[0]
+    if len(ranked) > 1 and ranked[1][0] >= score - 0.1:
+        # Two candidates are about as likely as each other
+        return False
+    return score >= CITY_AUTO_MATCH_SCORE or (victims_match and score >= CITY_LIKELY_MATCH_SCORE)
+
+
+def is_certain_mismatch(candidate):
+    score, _, victims_match = candidate
+    return score < CITY_NO_MATCH_SCORE and not victims_match
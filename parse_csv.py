@@ -16,164 +16,340 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import argparse
-from constants import API_URL, EMPTY_TEMPLATE, TEMPLATE, COMMENT, YEAR, REQUEST_HEADERS
+from concurrent.futures import ThreadPoolExecutor
+from constants import (YEAR, NOMINATIM_ENDPOINT, GEOCODE_RATE, GEOCODE_WORKERS, CSV_COLUMNS, CSV_DATE_FORMATS,
+                       STREAM_CHUNK_SIZE, STREAM_PROGRESS_FILE)
 import csv
 from datetime import datetime
+import hashlib
+from gazetteer import open_gazetteer
+from geocache import GeocodeCache
+from geocoder import Geocoder, prompt_coords, round_coords
+import instrumentation
+from instrumentation import metrics
 import json
-import re
-import requests
-import time
+import os
+from records import Shooting, create_id
+from storage import open_store, write_json_atomic
 
 
-def parse_arguments():
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument("action", help="update or write")
+    parser.add_argument("action", help="update, write, or stream")
+    parser.add_argument("-y", "--year", help="year of the dataset to parse", default=YEAR)
+    parser.add_argument("-c", "--csv", help="CSV file to read (default: YEAR.csv)")
     parser.add_argument("-i", "--interactive", help="input missing coordinates while script is running", action="store_true")
-    args = parser.parse_args()
-    if args.action not in ['update', 'write']:
-        raise Exception("Unrecognized action {}. Expected either 'update' or 'write'.".format(args.action))
+    parser.add_argument("--min-victims", help="skip incidents with fewer people killed and injured", type=int, default=0)
+    parser.add_argument("--state", help="only read incidents in this state (can be repeated)", action="append")
+    parser.add_argument("--all-years", help="when streaming, read every year in the CSV instead of only --year",
+                        action="store_true")
+    parser.add_argument("--chunk-size", help="when streaming, rows written to the store at a time", type=int,
+                        default=STREAM_CHUNK_SIZE)
+    parser.add_argument("--no-cache", help="don't read or write the geocoding cache", action="store_true")
+    parser.add_argument("--no-gazetteer", help="don't look up cities in the offline gazetteer", action="store_true")
+    parser.add_argument("--endpoint", help="Nominatim-compatible search endpoint", default=NOMINATIM_ENDPOINT)
+    parser.add_argument("--rate", help="maximum geocoding requests per second", type=float, default=GEOCODE_RATE)
+    parser.add_argument("--workers", help="number of concurrent geocoding lookups", type=int, default=GEOCODE_WORKERS)
+    parser.add_argument("--profile", help="profile the run with cProfile", action="store_true")
+    args = parser.parse_args(argv)
+    if args.action not in ['update', 'write', 'stream']:
+        raise Exception("Unrecognized action {}. Expected 'update', 'write', or 'stream'.".format(args.action))
     return args
 
 
-def create_id(ymd, city, state, shootings_dict):
-    """Create a unique ID from the date, city, and state of the event. The increment at the end handles the possibility
-    of multiple shootings in one city on the same day."""
-    id_prefix = "{}_{}_{}".format(ymd, city.replace(' ', ''), state.replace(' ', ''))
-    incr = 0
-    while "{}_{}".format(id_prefix, incr) in shootings_dict:
-        incr += 1
-    return "{}_{}".format(id_prefix, incr)
-
-
-def parse_req(req):
-    if req.status_code == 429:
-        raise Exception("OSM has rate-limited you. Molly probably needs to write better caching.")
-    req_json = json.loads(req.text)
-    if len(req_json) == 1:
-        return {"lat": req_json[0]["lat"], "lon": req_json[0]["lon"]}
-    return None
-
-
-def get_coords(street, city, state, interactive=False):
-    """Attempt to look up coordinates of the shooting using OpenStreetMap. If the script is run with the interactive
-    flag, the user will be prompted to enter coordinates if the location can't be found. Otherwise, the empty value
-    is written to the outfile with a comment indicating it needs to be updated."""
-    if street:
-        # Attempt to pull coords from OSM with street address
-        street = street.replace(" block of", "")
-        # A lot of these locations are written as "5000 block of X St.", which confuses OSM.
-        # Changing it to "5000 X St." helps OSM while remaining plenty precise.
-        req = requests.get(API_URL.format(street=street, city=re.sub("\(.*?\)", "", city), state=state, format="json"), headers=REQUEST_HEADERS)
-        coords = parse_req(req)
-        if coords:
-            return coords
-
-    # Attempt to pull coords from OSM without street address
-    req = requests.get(API_URL.format(street="", city=re.sub("\(.*?\)", "", city), state=state, format="json"), headers=REQUEST_HEADERS)
-    coords = parse_req(req)
-    if coords:
-        return coords
-
-    # If this still didn't work we'll need to do this manually
-    if interactive:
-        api_url = API_URL.format(street=street if street else "", city=city, state=state, format="html")
-        print("Find coordinates for {}, {}, {}: {}. Rounding will be done automatically.".format(street, city, state, api_url))
-        while True:
-            latlon = input("lat,lon: ")
-            try:
-                [lat, lon] = latlon.split(",")
-                return {"lat": lat.strip(), "lon": lon.strip()}
-            except ValueError:
-                print("Invalid input. Please enter comma-separated latitude and longitude.")
-    return None
-
-
-def round_coords(coords):
-    """Round lat/lon to 4 decimal points -- OSM often returns artificially precise values"""
-    if coords:
-        return {"lat": round(float(coords["lat"]), 4), "lon": round(float(coords["lon"]), 4)}
-    return None
-
-
-def main():
-    args = parse_arguments()
-    shootings_dict = {}
-    last_req = None
+def fingerprint_row(row):
+    """Hash the contents of a CSV row, so update mode can tell whether a row has changed since the last run."""
+    return hashlib.sha1("\x1f".join(row).encode("utf-8")).hexdigest()
+
+
+def is_unchanged(old_shooting, fingerprint, street, killed, injured):
+    """Check whether an existing entry is up-to-date with its CSV row. Entries written before fingerprints were stored
+    are compared field by field instead."""
+    if old_shooting.fingerprint is not None:
+        return old_shooting.fingerprint == fingerprint
+    return old_shooting.street == street and old_shooting.killed == killed and old_shooting.injured == injured
+
+
+def map_columns(header):
+    """Find the column each field is in, so the CSV's columns can be in any order, and extra columns are ignored."""
+    positions = {name.strip().lower(): position for position, name in enumerate(header)}
+    columns = {}
+    for field, names in CSV_COLUMNS.items():
+        for name in names:
+            if name.lower() in positions:
+                columns[field] = positions[name.lower()]
+                break
+        else:
+            raise Exception("The CSV has no column for the {}. Expected one of: {}.".format(field, ", ".join(names)))
+    return columns
+
+
+def parse_date(date):
+    for date_format in CSV_DATE_FORMATS:
+        try:
+            return datetime.strptime(date, date_format).strftime("%Y%m%d")
+        except ValueError:
+            pass
+    raise Exception("Unrecognized date {}.".format(date))
 
-    # Load existing JSON data
-    try:
-        with open(YEAR + ".json", encoding="utf-8") as shootings_json_file:
-            if args.action == 'update':
-                old_shootings_dict = json.load(shootings_json_file)
-                old_shootings_keys_const = list(old_shootings_dict.keys())
-                remaining_old_keys = old_shootings_keys_const.copy()
-            else:
-                print(YEAR + ".json already exists. Do you really want to continue in write mode and overwrite the file?")
-                confirm = input("Type 'y' to confirm, or any other character to exit: ")
-                if confirm not in ['y', 'Y']:
-                    return
-    except FileNotFoundError:
-        old_shootings_dict = None
 
-    # Read CSV
-    with open(YEAR + ".csv", newline="\n", encoding='utf-8') as csvfile:
+def iter_csv_rows(path, year=None, min_victims=0, states=None, skip=0):
+    """Read a GVA CSV export one row at a time, yielding the row number and the fields of each row that passes the
+    filters. Rows up to and including row number `skip` are passed over without being parsed."""
+    states = {state.lower() for state in states} if states else None
+    with open(path, newline="", encoding="utf-8") as csvfile:
         reader = csv.reader(csvfile, delimiter=",")
-        next(reader)  # Skip the header row
-        for row in reader:
-            # Parse date and get ID
-            [date, state, city, street, killed, injured, *_] = row
-            parsed_date = datetime.strptime(date, "%B %d, %Y")
-            ymd = parsed_date.strftime("%Y%m%d")
-            entry_id = create_id(ymd, city, state, shootings_dict)
-
-            if args.action == 'update' and old_shootings_dict and entry_id in old_shootings_dict:
-                remaining_old_keys.remove(entry_id)
-                if street == old_shootings_dict[entry_id]["street"] and old_shootings_dict[entry_id]["lat"]:
-                    print("Found {} - {}: {}, {}, {}".format(entry_id, date, street, city, state))
-                    coords = {
-                        "lat": old_shootings_dict[entry_id]["lat"],
-                        "lon": old_shootings_dict[entry_id]["lon"]
-                    }
-                else:
-                    print("Found {} with missing or outdated info - {}: {}, {}, {}".format(entry_id, date, street, city, state))
-                    if last_req and (datetime.now() - last_req).seconds < 1:
-                        # Respect OSM's 1-second rate limit policy
-                        time.sleep(1)
-                    last_req = datetime.now()
-                    coords = get_coords(street, city, state, interactive=args.interactive)
-            else:
-                print("Processing new entry {} - {}: {}, {}, {}".format(entry_id, date, street, city, state))
-                if last_req and (datetime.now() - last_req).seconds < 1:
-                    # Respect OSM's 1-second rate limit policy
-                    time.sleep(1)
-                last_req = datetime.now()
-                coords = get_coords(street, city, state, interactive=args.interactive)
-
-            rounded_coords = round_coords(coords)
-
-            # New entry
-            shootings_dict[entry_id] = {
+        columns = map_columns(next(reader))
+        for row_number, row in enumerate(reader, 1):
+            if row_number <= skip:
+                continue
+            ymd = parse_date(row[columns["date"]])
+            killed = int(row[columns["killed"]] or 0)
+            injured = int(row[columns["injured"]] or 0)
+            if ((year and ymd[:4] != year) or killed + injured < min_victims
+                    or (states and row[columns["state"]].lower() not in states)):
+                continue
+            yield row_number, {
+                "incident_date": row[columns["date"]],
                 "date": ymd,
-                "state": state,
-                "city": city,
-                "street": street,
-                "wikilink_target": None,
-                "killed": int(killed),
-                "injured": int(injured),
-                "total": int(killed) + int(injured),
-                "lat": rounded_coords["lat"] if rounded_coords else None,
-                "lon": rounded_coords["lon"] if rounded_coords else None,
-                "description": None,
-                "refs": []
+                "state": row[columns["state"]],
+                "city": row[columns["city"]],
+                "street": row[columns["street"]],
+                "killed": killed,
+                "injured": injured,
+                "fingerprint": fingerprint_row(row)
             }
 
-    with open(YEAR + ".json", "w", encoding="utf-8") as shootings_json_file:
-        json.dump(shootings_dict, shootings_json_file, indent=2, sort_keys=True)
 
-    if args.action == 'update' and len(remaining_old_keys) >= 1:
+def update_entry(row, old_shooting):
+    """Build the entry for a CSV row, starting from the existing entry if there is one. Returns the entry, whether it
+    was added, changed, or unchanged, and whether its location needs to be looked up."""
+    if old_shooting and is_unchanged(old_shooting, row["fingerprint"], row["street"], row["killed"], row["injured"]):
+        # Nothing has changed in the CSV, so keep the entry as-is, including anything merged in from the wikicode. If
+        # an earlier lookup failed, try it again.
+        shooting = old_shooting.copy()
+        shooting.fingerprint = row["fingerprint"]
+        return shooting, "unchanged", not old_shooting.lat
+    if old_shooting:
+        shooting = old_shooting.copy()
+        status = "changed"
+        needs_lookup = not (row["street"] == old_shooting.street and old_shooting.lat)
+        if needs_lookup:
+            shooting.lat = None
+            shooting.lon = None
+    else:
+        shooting = Shooting(row["date"], row["state"], row["city"])
+        status = "added"
+        needs_lookup = True
+    shooting.date = row["date"]
+    shooting.state = row["state"]
+    shooting.city = row["city"]
+    shooting.street = row["street"]
+    shooting.killed = row["killed"]
+    shooting.injured = row["injured"]
+    shooting.total = row["killed"] + row["injured"]
+    shooting.fingerprint = row["fingerprint"]
+    return shooting, status, needs_lookup
+
+
+def fill_coords(shootings_dict, lookups, interactive=False):
+    """Wait for the geocoding lookups, and fill in the coordinates they found."""
+    for entry_id, lookup in lookups.items():
+        shooting = shootings_dict[entry_id]
+        coords = lookup.result()
+        if not coords and interactive:
+            metrics.increment("geocode_prompted")
+            coords = prompt_coords(shooting.street, shooting.city, shooting.state)
+        rounded_coords = round_coords(coords)
+        if rounded_coords:
+            shooting.lat = rounded_coords["lat"]
+            shooting.lon = rounded_coords["lon"]
+
+
+def read_csv(path, old_shootings_dict, geocoder, workers=GEOCODE_WORKERS, interactive=False, year=None,
+             min_victims=0, states=None):
+    """Parse a GVA CSV into entries. Entries in old_shootings_dict whose rows haven't changed are kept as they are, and
+    new entries and entries whose location changed are geocoded. Returns the entries, the number added, changed, and
+    unchanged, and the IDs of old entries that weren't in the CSV."""
+    shootings_dict = {}
+    lookups = {}
+    counts = {"added": 0, "changed": 0, "unchanged": 0}
+    remaining_old_keys = set(old_shootings_dict.keys())
+
+    # Lookups are handed off to the geocoding workers as rows are read, and the coordinates are filled in once every
+    # row has been parsed.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        with metrics.stage("read_csv") as read_stage:
+            for _, row in iter_csv_rows(path, year, min_victims, states):
+                entry_id = create_id(row["date"], row["city"], row["state"], shootings_dict)
+                remaining_old_keys.discard(entry_id)
+                shooting, status, needs_lookup = update_entry(row, old_shootings_dict.get(entry_id))
+                counts[status] += 1
+                location = "{}: {}, {}, {}".format(row["incident_date"], row["street"], row["city"], row["state"])
+                if status == "added":
+                    print("Processing new entry {} - {}".format(entry_id, location))
+                elif status == "changed" and needs_lookup:
+                    print("Found {} with missing or outdated location - {}".format(entry_id, location))
+                elif status == "changed":
+                    print("Found {} with updated info - {}".format(entry_id, location))
+                elif needs_lookup:
+                    print("Retrying lookup for {} with missing location - {}".format(entry_id, location))
+                if needs_lookup:
+                    lookups[entry_id] = executor.submit(geocoder.geocode, row["street"], row["city"], row["state"])
+                shootings_dict[entry_id] = shooting
+            read_stage["rows"] = len(shootings_dict)
+
+        with metrics.stage("geocode") as geocode_stage:
+            geocode_stage["rows"] = len(lookups)
+            fill_coords(shootings_dict, lookups, interactive)
+    return shootings_dict, counts, remaining_old_keys
+
+
+def load_progress(path, csv_path):
+    """Return the progress left by an interrupted stream of this CSV, if there is one."""
+    try:
+        with open(path, encoding="utf-8") as progress_file:
+            progress = json.load(progress_file)
+    except FileNotFoundError:
+        return None
+    if progress["csv"] != os.path.abspath(csv_path) or progress["size"] != os.path.getsize(csv_path):
+        print("Ignoring progress from a different or changed CSV ({}).".format(progress["csv"]))
+        return None
+    return progress
+
+
+def stream_csv(path, store, geocoder, year=None, min_victims=0, states=None, chunk_size=STREAM_CHUNK_SIZE,
+               workers=GEOCODE_WORKERS):
+    """Read a CSV of any size into the store, a chunk of rows at a time, so memory use doesn't grow with the input.
+    Progress is saved after each chunk is written, and a run that was interrupted picks up after the last chunk.
+    Rows must be grouped by date, as they are in GVA exports, so that IDs can be assigned without remembering every
+    row. Unlike update mode, entries missing from the CSV are never removed."""
+    progress_path = STREAM_PROGRESS_FILE.format(name=os.path.splitext(os.path.basename(path))[0])
+    progress = load_progress(progress_path, path) or {
+        "csv": os.path.abspath(path),
+        "size": os.path.getsize(path),
+        "rows": 0,
+        "counts": {"added": 0, "changed": 0, "unchanged": 0},
+        "finished_dates": [],
+        "current_date": None,
+        "current_ids": []
+    }
+    if progress["rows"]:
+        print("Resuming after row {}.".format(progress["rows"]))
+    counts = progress["counts"]
+    finished_dates = set(progress["finished_dates"])
+    current_date = progress["current_date"]
+    current_ids = set(progress["current_ids"])
+    chunk = {}
+
+    def write_chunk(last_row):
+        old_shootings_dict = store.load_ids(chunk.keys())
+        shootings_dict = {}
+        lookups = {}
+        for entry_id, row in chunk.items():
+            shooting, status, needs_lookup = update_entry(row, old_shootings_dict.get(entry_id))
+            counts[status] += 1
+            if needs_lookup:
+                lookups[entry_id] = executor.submit(geocoder.geocode, row["street"], row["city"], row["state"])
+            shootings_dict[entry_id] = shooting
+        fill_coords(shootings_dict, lookups)
+        store.upsert({k: v for k, v in shootings_dict.items() if old_shootings_dict.get(k) != v})
+        progress.update(rows=last_row, finished_dates=sorted(finished_dates), current_date=current_date,
+                        current_ids=sorted(current_ids))
+        write_json_atomic(progress_path, progress)
+        print("Wrote rows up to {}: {} added, {} changed, {} unchanged so far.".format(
+            last_row, counts["added"], counts["changed"], counts["unchanged"]))
+        chunk.clear()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, metrics.stage("stream") as stream_stage:
+        row_number = progress["rows"]
+        for row_number, row in iter_csv_rows(path, year, min_victims, states, skip=progress["rows"]):
+            if row["date"] != current_date:
+                if row["date"] in finished_dates:
+                    raise Exception("Row {} is dated {}, but that date appeared earlier in the CSV. Streaming needs the "
+                                    "rows to be grouped by date.".format(row_number, row["incident_date"]))
+                if current_date:
+                    finished_dates.add(current_date)
+                current_date = row["date"]
+                current_ids = set()
+            entry_id = create_id(row["date"], row["city"], row["state"], current_ids)
+            current_ids.add(entry_id)
+            chunk[entry_id] = row
+            if len(chunk) >= chunk_size:
+                write_chunk(row_number)
+            stream_stage["rows"] = row_number
+        if chunk:
+            write_chunk(row_number)
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    return counts
+
+
+def print_changes(counts, removed):
+    print("{} added, {} changed, {} unchanged, {} removed.".format(counts["added"], counts["changed"],
+                                                               counts["unchanged"], len(removed)))
+    if removed:
         print("The following entries were found in the previous record of shootings but were not found in the new CSV."
               "Consider checking these to ensure duplicate entries have not been added.")
-        [print(x) for x in remaining_old_keys]
+        [print(x) for x in sorted(removed)]
+
+
+def main(argv=None, geocoder=None, store=None):
+    args = parse_arguments(argv)
+    year = "all" if args.action == "stream" and args.all_years else args.year
+    with instrumentation.run("parse_csv", year, profile=args.profile):
+        ingest(args, geocoder, store)
+
+
+def ingest(args, geocoder=None, store=None):
+    """Read the CSV, geocode new and moved entries, and save them to the store."""
+    csv_path = args.csv or args.year + ".csv"
+    owns_store = store is None
+    if owns_store:
+        store = open_store()
+    owns_geocoder = geocoder is None
+    if owns_geocoder:
+        geocoder = Geocoder(endpoint=args.endpoint, rate=args.rate, cache=None if args.no_cache else GeocodeCache(),
+                            pool_size=args.workers, gazetteer=None if args.no_gazetteer else open_gazetteer())
+
+    try:
+        if args.action == 'stream':
+            counts = stream_csv(csv_path, store, geocoder, None if args.all_years else args.year, args.min_victims,
+                                args.state, args.chunk_size, args.workers)
+            print("{} added, {} changed, {} unchanged.".format(counts["added"], counts["changed"], counts["unchanged"]))
+        else:
+            read_year(args, csv_path, store, geocoder)
+    finally:
+        if owns_geocoder:
+            geocoder.close()
+        if owns_store:
+            store.close()
+
+
+def read_year(args, csv_path, store, geocoder):
+    """Read one year's entries into memory, and save the changes when they've all been read."""
+    # Load existing data
+    with metrics.stage("load"):
+        old_shootings_dict = store.load(args.year)
+    if old_shootings_dict and args.action == 'write':
+        print("Entries for " + args.year + " already exist. Do you really want to continue in write mode and overwrite them?")
+        confirm = input("Type 'y' to confirm, or any other character to exit: ")
+        if confirm not in ['y', 'Y']:
+            return
+        old_shootings_dict = {}
+
+    shootings_dict, counts, removed = read_csv(csv_path, old_shootings_dict, geocoder, args.workers, args.interactive,
+                                               args.year, args.min_victims, args.state)
+    with metrics.stage("save"):
+        if old_shootings_dict:
+            # Only write the entries that changed
+            store.upsert({k: v for k, v in shootings_dict.items() if old_shootings_dict.get(k) != v})
+            store.delete(removed)
+        else:
+            store.save(args.year, shootings_dict)
+
+    if old_shootings_dict:
+        print_changes(counts, removed)
 
 
 if __name__ == "__main__":
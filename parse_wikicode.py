@@ -15,23 +15,54 @@
 # DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from constants import API_URL, EMPTY_TEMPLATE, TEMPLATE, COMMENT, COMMENT_LOCATION, YEAR, REQUEST_HEADERS
-from parse_csv import create_id, get_coords, round_coords
+import argparse
+from buildcache import file_hash, key, store_hash
+from citations import REF_REGEX
+from constants import (API_URL, YEAR, REVIEW_FILE, CHECKPOINT_FILE, CHECKPOINT_INTERVAL, NOMINATIM_ENDPOINT,
+                       GEOCODE_RATE)
 from datetime import datetime
+from geocache import GeocodeCache
+from gazetteer import open_gazetteer
+from geocoder import Geocoder, get_coords, round_coords
+import instrumentation
+from instrumentation import metrics
+from matching import ShootingIndex, is_certain_match, is_certain_mismatch
 import json
+import os
 import re
+from records import Shooting, create_id, from_dicts, to_dicts
+import time
+from review import ReviewQueue
+from storage import open_store, write_json_atomic
 
 MONTHS_EXPR = "(?:January|February|March|April|May|June|July|August|September|October|November|December)"
-DATE_LINE_EXPR = "(?:\n*\|(?:{{dts\|)?(?P<date>" + MONTHS_EXPR + " \d+, \d{4})(?:}})?)\n*"
-LOCATION_EXPR = "\|\[\[(?P<wikilink_target>.*\|)?(?P<loc>.*)\]\]\n*"
-KILLED_EXPR = "\|(?P<killed>\d+).*\n*"
-INJURED_EXPR = "\|(?P<injured>\d+).*\n*"
-TOTAL_EXPR = "\|'''(?P<total>\d+)'''.*\n*"
-DESC_EXPR = "\|(?P<desc>.*?)"
-REFS_EXPR = "(?P<ref><ref.*<\/ref>)+\n*"
-REF_EXPR = "(<ref.*?>.*?</ref>)"
-MATCH_EXPR = DATE_LINE_EXPR + LOCATION_EXPR + KILLED_EXPR + INJURED_EXPR + TOTAL_EXPR + DESC_EXPR + REFS_EXPR
-MATCH_REGEX = re.compile(MATCH_EXPR, flags=re.IGNORECASE)
+DATE_REGEX = re.compile("(?P<date>" + MONTHS_EXPR + r" \d+, \d{4})", flags=re.IGNORECASE)
+LOCATION_REGEX = re.compile(r"\[\[(?P<wikilink_target>[^\]]*\|)?(?P<loc>[^\]|]*)\]\]")
+LINK_REGEX = re.compile(r"\[\[(?:[^\]]*\|)?(?P<text>[^\]|]*)\]\]")
+NUMBER_REGEX = re.compile(r"(?:''')?(?P<number>\d+)")
+# Anything that opens or closes a span in which a line starting with "|" doesn't start a new cell
+NESTING_REGEX = re.compile(r"{{|}}|<ref[^>]*?/>|<ref[^>]*>|</ref>", flags=re.IGNORECASE)
+ROW_CELLS = ["date", "location", "killed", "injured", "total", "desc"]
+DEFERRED = "deferred"
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", nargs="?", help="'merge' (the default) or 'resolve'", default="merge")
+    parser.add_argument("-y", "--year", help="year of the dataset to merge into", default=YEAR)
+    parser.add_argument("-w", "--wikitext", help="file containing the body of the wikitable", default="wikitext.txt")
+    parser.add_argument("-b", "--batch", help="queue conflicts in the review file instead of prompting",
+                        action="store_true")
+    parser.add_argument("-i", "--interactive", help="when resolving, prompt for conflicts that haven't been decided",
+                        action="store_true")
+    parser.add_argument("--no-cache", help="don't read or write the geocoding cache", action="store_true")
+    parser.add_argument("--endpoint", help="Nominatim-compatible search endpoint", default=NOMINATIM_ENDPOINT)
+    parser.add_argument("--rate", help="maximum geocoding requests per second", type=float, default=GEOCODE_RATE)
+    parser.add_argument("--profile", help="profile the run with cProfile", action="store_true")
+    args = parser.parse_args(argv)
+    if args.action not in ['merge', 'resolve']:
+        raise Exception("Unrecognized action {}. Expected either 'merge' or 'resolve'.".format(args.action))
+    return args
 
 
 def prompt_location(loc, ymd):
@@ -42,134 +73,445 @@ def prompt_location(loc, ymd):
     return [city.strip(), state.strip()]
 
 
-def get_location(loc, ymd):
-    """Get city and state from location string."""
+def parse_location(loc):
+    """Get city and state from location string, or None if it can't be parsed."""
     if any(char in loc for char in ["[", "]", "|"]):
-        # Our effort at parsing the location hasn't worked, prompt for string to avoid messy data.
-        return prompt_location(loc, ymd)
+        # Our effort at parsing the location hasn't worked, don't guess to avoid messy data.
+        return None
     try:
         [city, state] = loc.rsplit(",", 1)
         return [city.strip(), state.strip()]
     except ValueError:
-        return prompt_location(loc, ymd)
+        return None
 
 
-def find_id(ymd, match, shootings_dict):
-    """This tries to return a matching ID for the entry, or None if no entry exists in the dictionary."""
-    [city, state] = get_location(match.group("loc"), ymd)
+def get_location(loc, ymd):
+    """Get city and state from location string, prompting for them if it can't be parsed."""
+    return parse_location(loc) or prompt_location(loc, ymd)
+
+
+def find_id(ymd, row, shootings_dict, index, queue=None):
+    """This tries to return a matching ID for the entry, or None if no entry exists in the dictionary. If a review
+    queue is given, anything that would need a human to decide is queued instead and DEFERRED is returned."""
+    location = parse_location(row["loc"])
+    if not location and queue is not None:
+        queue.add("location", "{}: couldn't find location in '{}'. Decide with 'city, state'.".format(ymd, row["loc"]),
+                  None, ymd=ymd, row=row)
+        return DEFERRED
+    [city, state] = location or prompt_location(row["loc"], ymd)
+    candidates = []
     # First try to match based on exact ID
     incr = 0
+    rejected_ids = set()
     shooting_id = "{}_{}_{}_{}".format(ymd, city.replace(" ", ""), state.replace(" ", ""), incr)
     while shooting_id in shootings_dict:
-        if int(match.group('killed')) == shootings_dict[shooting_id]["killed"] and int(match.group('injured')) == shootings_dict[shooting_id]["injured"]:
+        if int(row["killed"]) == shootings_dict[shooting_id].killed and int(row["injured"]) == shootings_dict[shooting_id].injured:
             return shooting_id
+        if queue is not None:
+            candidates.append(shooting_id)
         else:
             print("ID {} found, but killed/injured values don\'t match. Please manually confirm.".format(shooting_id))
-            print(match.groups())
-            print(shootings_dict[shooting_id])
+            print(row)
+            print(shootings_dict[shooting_id].to_dict())
             confirm = input("Is this the same incident? ['y' to confirm, any other character if not]: ")
             if confirm in ['y', 'Y']:
                 return shooting_id
-            incr += 1
-            shooting_id = "{}_{}_{}_{}".format(ymd, city.replace(" ", ""), state.replace(" ", ""), incr)
-
-    # No exact ID found, try to match more broadly
-    keys = list(shootings_dict.keys())
-    key_date_matches = list(filter(lambda x: x.startswith(ymd), keys))
-    for key_date_match in key_date_matches:
-        parts = key_date_match.split("_")
-        if parts[2] == state:
-            print("Found shooting in {} on {}. City in JSON file is '{}'; city in wikicode is '{}'. Is this the"
-                  " same incident? (You can fix the values later)".format(state, ymd, shootings_dict[key_date_match]["city"], city))
-            confirm = input("['y' to confirm, any other character if not]: ")
-            if confirm in ['y', 'Y']:
-                return key_date_match
+        rejected_ids.add(shooting_id)
+        incr += 1
+        shooting_id = "{}_{}_{}_{}".format(ymd, city.replace(" ", ""), state.replace(" ", ""), incr)
 
+    # No exact ID found, try to match more broadly against other shootings on the same day
+    ranked = [candidate for candidate in index.rank(ymd, city, state, int(row["killed"]), int(row["injured"]))
+              if candidate[1] not in rejected_ids]
+    if is_certain_match(ranked):
+        print("Matched {}, {} on {} to {}.".format(city, state, ymd, ranked[0][1]))
+        return ranked[0][1]
+    for candidate in ranked:
+        if is_certain_mismatch(candidate):
+            continue
+        candidate_id = candidate[1]
+        if queue is not None:
+            candidates.append(candidate_id)
+            continue
+        print("Found shooting in {} on {}. City in JSON file is '{}'; city in wikicode is '{}'. Is this the"
+              " same incident? (You can fix the values later)".format(state, ymd, shootings_dict[candidate_id].city, city))
+        confirm = input("['y' to confirm, any other character if not]: ")
+        if confirm in ['y', 'Y']:
+            return candidate_id
+
+    if candidates:
+        queue.add("match", "{}: {}, {} ({} killed, {} injured) may be the same incident as {}. Decide with 'accept', "
+                  "another candidate ID, or 'new'.".format(ymd, city, state, row["killed"], row["injured"],
+                                                           ", ".join(candidates)),
+                  candidates[0], ymd=ymd, row=row, candidates=candidates)
+        return DEFERRED
     return None
 
 
-def get_refs(match):
-    if match.group("ref"):
-        refs = re.split(REF_EXPR, match.group("ref"))
-        filtered_refs = list(filter(lambda x: x.startswith("<ref"), refs))
-        return filtered_refs
-    return []
+def nesting_change(line):
+    """Return how much deeper into templates and <ref> tags the wikicode is at the end of this line than at the start.
+    Cite templates and refs can span lines, and their lines may start with "|" or even "|-"."""
+    depth = 0
+    for token in NESTING_REGEX.findall(line):
+        if token == "{{":
+            depth += 1
+        elif token == "}}" or token.startswith("</"):
+            depth -= 1
+        elif not token.endswith("/>"):
+            depth += 1
+    return depth
+
+
+def split_refs(cell):
+    """Split the run of refs off the end of the description cell. Refs in the middle of the description are left in
+    place."""
+    refs = []
+    for ref in REF_REGEX.finditer(cell):
+        if refs and cell[refs[-1].end():ref.start()].strip():
+            refs = []
+        refs.append(ref)
+    if not refs or cell[refs[-1].end():].strip():
+        return cell.strip(), []
+    return cell[:refs[0].start()].strip(), [ref.group(0) for ref in refs]
+
+
+def parse_row(cells):
+    """Turn the cells of one wikitable row into a dictionary, or return None if they don't look like a shooting."""
+    if len(cells) < len(ROW_CELLS):
+        return None
+    # Anything past the description cell is treated as part of it
+    row = dict(zip(ROW_CELLS, cells[:len(ROW_CELLS) - 1] + ["\n|".join(cells[len(ROW_CELLS) - 1:])]))
+    date = DATE_REGEX.search(row["date"])
+    location = LOCATION_REGEX.fullmatch(row["location"].strip())
+    numbers = [NUMBER_REGEX.match(row[cell].strip()) for cell in ["killed", "injured", "total"]]
+    if not date or not LINK_REGEX.search(row["location"]) or not all(numbers):
+        return None
+    if location:
+        wikilink_target, loc = location.group("wikilink_target"), location.group("loc")
+    else:
+        # Cells like "[[Atlanta]], [[Georgia (U.S. state)|Georgia]]" link more than one place; keep just the text.
+        wikilink_target, loc = None, LINK_REGEX.sub(lambda link: link.group("text"), row["location"]).strip()
+    desc, refs = split_refs(row["desc"])
+    return {
+        "date": date.group("date"),
+        "wikilink_target": wikilink_target,
+        "loc": loc,
+        "killed": numbers[0].group("number"),
+        "injured": numbers[1].group("number"),
+        "total": numbers[2].group("number"),
+        "desc": desc,
+        "refs": refs
+    }
+
+
+def parse_row_or_raise(cells):
+    row = parse_row(cells)
+    if not row:
+        print("|" + "\n|".join(cells))
+        raise Exception("Unable to parse line")
+    return row
+
+
+def iter_rows(lines):
+    """Read the body of a wikitable line by line, yielding one dictionary per row. A line starting with "|" starts a new
+    cell and "|-" starts a new row, unless it's inside a template or ref."""
+    cells = []
+    depth = 0
+    for line in lines:
+        line = line.rstrip("\n")
+        if depth <= 0:
+            depth = 0
+            if line.rstrip() == "|-":
+                if cells:
+                    yield parse_row_or_raise(cells)
+                cells = []
+                continue
+            if line.startswith("|"):
+                cells.append(line[1:])
+                depth += nesting_change(line)
+                continue
+        if cells:
+            cells[-1] += "\n" + line
+        depth += nesting_change(line)
+    if cells:
+        yield parse_row_or_raise(cells)
+
+
+def check_total(entry_id, shootings_dict, queue=None):
+    """Make sure the total number of victims adds up, offering to fix it if not."""
+    shooting = shootings_dict[entry_id]
+    if shooting.killed + shooting.injured == shooting.total:
+        return
+    message = "Total number of victims doesn't add up ({} killed, {} injured, {} total). Update to {}?".format(
+        shooting.killed, shooting.injured, shooting.total, shooting.killed + shooting.injured)
+    if queue is not None:
+        queue.add("field", "{}: {}".format(entry_id, message), shooting.killed + shooting.injured,
+                  entry_id=entry_id, field="total", current=shooting.total)
+        return
+    print(message)
+    confirm = input("['y' to confirm, any other character if not]: ")
+    if confirm in ['y', 'Y']:
+        shooting.total = shooting.killed + shooting.injured
+
+
+def merge_entry(entry_id, row, shootings_dict, queue=None):
+    """There's a matching entry in the JSON file, update it with the wikicode values."""
+    shooting = shootings_dict[entry_id]
+    for field in ["killed", "injured"]:
+        if int(row[field]) != getattr(shooting, field):
+            message = "Number of people {} for ID {} doesn't match. (JSON: {}, wikicode: {})".format(
+                field, entry_id, getattr(shooting, field), row[field])
+            if queue is not None:
+                queue.add("field", message, int(row[field]), entry_id=entry_id, field=field,
+                          current=getattr(shooting, field))
+            else:
+                print(message)
+                setattr(shooting, field, int(input("Enter number of people {}: ".format(field))))
+    check_total(entry_id, shootings_dict, queue)
+    if row["wikilink_target"]:
+        shooting.wikilink_target = row["wikilink_target"]
+    shooting.description = row["desc"]
+    shooting.refs = row["refs"]
+
+
+def add_entry(ymd, row, shootings_dict, index, geocoder, queue=None):
+    """This is a new entry."""
+    [city, state] = get_location(row["loc"], ymd)
+    entry_id = create_id(ymd, city, state, shootings_dict)
+    coords = get_coords(None, city, state, interactive=queue is None, geocoder=geocoder)
+    rounded_coords = round_coords(coords)
+    shootings_dict[entry_id] = Shooting(
+        ymd, state, city,
+        wikilink_target=row["wikilink_target"],
+        killed=int(row["killed"]),
+        injured=int(row["injured"]),
+        total=int(row["total"]),
+        lat=rounded_coords["lat"] if rounded_coords else None,
+        lon=rounded_coords["lon"] if rounded_coords else None,
+        description=row["desc"],
+        refs=row["refs"]
+    )
+    index.add(entry_id)
+    if not rounded_coords and queue is not None:
+        queue.add("coordinates", "{}: couldn't find coordinates for {}, {}. Decide with 'lat,lon': {}".format(
+            entry_id, city, state, API_URL.format(street="", city=city, state=state, format="html")),
+            None, entry_id=entry_id)
+    check_total(entry_id, shootings_dict, queue)
 
 
-def main():
-    # Load existing JSON data
+def merge_row(ymd, row, shootings_dict, index, geocoder, queue=None):
+    start = time.perf_counter()
+    entry_id = find_id(ymd, row, shootings_dict, index, queue)
+    metrics.add_duration("matching", time.perf_counter() - start)
+    if entry_id == DEFERRED:
+        metrics.increment("rows_deferred")
+        return
+    if entry_id:
+        metrics.increment("rows_matched")
+        merge_entry(entry_id, row, shootings_dict, queue)
+    else:
+        metrics.increment("rows_added")
+        add_entry(ymd, row, shootings_dict, index, geocoder, queue)
+
+
+def apply_decision(conflict, shootings_dict, index, geocoder, queue):
+    """Apply a reviewed conflict. Returns False if the decision wasn't understood, so the conflict can be kept for
+    another look. Anything new that comes up while applying it is added to the queue."""
+    decision = conflict["decision"]
+    if decision == "accept":
+        decision = conflict["proposed"]
+    if conflict["type"] == "location":
+        location = parse_location(decision or "")
+        if not location:
+            return False
+        merge_row(conflict["ymd"], dict(conflict["row"], loc=", ".join(location)), shootings_dict, index, geocoder,
+                  queue)
+    elif conflict["type"] == "match":
+        if decision == "new":
+            add_entry(conflict["ymd"], conflict["row"], shootings_dict, index, geocoder, queue)
+        elif decision in shootings_dict:
+            merge_entry(decision, conflict["row"], shootings_dict, queue)
+        else:
+            return False
+    elif conflict["type"] == "field":
+        if decision == "reject":
+            return True
+        try:
+            setattr(shootings_dict[conflict["entry_id"]], conflict["field"], int(decision))
+        except (TypeError, ValueError):
+            return False
+        if conflict["field"] != "total":
+            check_total(conflict["entry_id"], shootings_dict, queue)
+    elif conflict["type"] == "coordinates":
+        if decision == "reject":
+            return True
+        try:
+            [lat, lon] = decision.split(",")
+            rounded_coords = round_coords({"lat": lat, "lon": lon})
+        except (AttributeError, ValueError):
+            return False
+        shootings_dict[conflict["entry_id"]].lat = rounded_coords["lat"]
+        shootings_dict[conflict["entry_id"]].lon = rounded_coords["lon"]
+    elif conflict["type"] == "duplicate":
+        if decision == "reject":
+            return True
+        if decision not in conflict["entry_ids"]:
+            return False
+        shootings_dict.pop(decision, None)
+    return True
+
+
+def load_checkpoint(path, wikitext, inputs):
+    """Return the checkpoint left by an interrupted merge of this wikitext file into these entries, if there is one.
+    inputs is the hash of the wikitext and the entries the merge started from; if either has changed since, resuming
+    would throw away the changes or skip the wrong rows, so the checkpoint is ignored."""
     try:
-        with open(YEAR + ".json", encoding="utf-8") as shootings_json_file:
-            shootings_dict = json.load(shootings_json_file)
+        with open(path, encoding="utf-8") as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
     except FileNotFoundError:
-        raise Exception("This is meant to be run after gva.py, and expects a JSON file to be available.")
+        return None
+    if checkpoint["wikitext"] != wikitext:
+        print("Ignoring checkpoint for a different wikitext file ({}).".format(checkpoint["wikitext"]))
+        return None
+    if checkpoint.get("inputs") != inputs:
+        print("Ignoring checkpoint, since the wikitext or the entries have changed since it was saved.")
+        return None
+    return checkpoint
+
+
+def remove_checkpoint(year):
+    """Call once the merged entries have been saved."""
+    if os.path.exists(CHECKPOINT_FILE.format(year=year)):
+        os.remove(CHECKPOINT_FILE.format(year=year))
+
+
+def merge(shootings_dict, geocoder, wikitext, year, batch=False):
+    """Merge the wikitext into the entries, checkpointing progress so an interrupted run can pick up where it left
+    off. In batch mode, conflicts are queued in the review file instead of prompting."""
+    checkpoint_path = CHECKPOINT_FILE.format(year=year)
+    review_path = REVIEW_FILE.format(year=year)
+    inputs = key(file_hash(wikitext), store_hash(shootings_dict))
+    checkpoint = load_checkpoint(checkpoint_path, wikitext, inputs)
+    rows_done = 0
+    # Add to the conflicts already waiting for review, including any queued by validate.py, rather than replacing them
+    queue = ReviewQueue.load(review_path) if batch else None
+    if batch and any(conflict["decision"] is not None for conflict in queue.conflicts):
+        raise Exception("{} has decisions that haven't been applied yet. Run with 'resolve' first.".format(review_path))
+    if checkpoint:
+        print("Resuming from checkpoint after {} rows.".format(checkpoint["rows"]))
+        shootings_dict = from_dicts(checkpoint["shootings"])
+        rows_done = checkpoint["rows"]
+        if batch:
+            queue = ReviewQueue(checkpoint["conflicts"])
+    index = ShootingIndex(shootings_dict)
+
+    def save_checkpoint():
+        start = time.perf_counter()
+        write_json_atomic(checkpoint_path, {"wikitext": wikitext, "inputs": inputs, "rows": rows_done,
+                                            "shootings": to_dicts(shootings_dict),
+                                            "conflicts": queue.conflicts if queue else []})
+        metrics.add_duration("checkpoint", time.perf_counter() - start)
 
     # Read wikicode
-    with open("wikitext.txt", encoding='utf-8') as infile:
-        entries = infile.read().split("|-")
-        for entry in entries:
-            if not entry:
-                continue
-            match = MATCH_REGEX.search(entry)
-            if not match:
-                print(entry)
-                raise Exception("Unable to parse line")
-            parsed_date = datetime.strptime(match.group("date"), "%B %d, %Y")
-            ymd = parsed_date.strftime("%Y%m%d")
-            entry_id = find_id(ymd, match, shootings_dict)
-            if entry_id:
-                # There's a matching entry in the JSON file, update it with the wikicode values.
-                if int(match.group("killed")) != shootings_dict[entry_id]["killed"]:
-                    print("Number of people killed for ID {} doesn't match. (JSON: {}, wikicode: {})".format(entry_id, shootings_dict[entry_id]["killed"], match.group("killed")))
-                    killed = input("Enter number of people killed: ")
-                    shootings_dict[entry_id]["killed"] = int(killed)
-                if int(match.group("injured")) != shootings_dict[entry_id]["injured"]:
-                    print("Number of people injured for ID {} doesn't match. (JSON: {}, wikicode: {})".format(entry_id, shootings_dict[entry_id]["injured"], match.group("injured")))
-                    injured = input("Enter number of people injured: ")
-                    shootings_dict[entry_id]["injured"] = int(injured)
-                if shootings_dict[entry_id]["injured"] + shootings_dict[entry_id]["killed"] != shootings_dict[entry_id]["total"]:
-                    print("Total number of victims doesn't add up ({} killed, {} injured, {} total). Update to {}?"
-                          .format(shootings_dict[entry_id]["killed"], shootings_dict[entry_id]["injured"],
-                                  shootings_dict[entry_id]["total"],
-                                  shootings_dict[entry_id]["killed"] + shootings_dict[entry_id]["injured"]))
-                    confirm = input("['y' to confirm, any other character if not]: ")
-                    if confirm in ['y', 'Y']:
-                        shootings_dict[entry_id]["total"] = shootings_dict[entry_id]["killed"] + shootings_dict[entry_id]["injured"]
-                if match.group("wikilink_target"):
-                    shootings_dict[entry_id]["wikilink_target"] = match.group("wikilink_target")
-                shootings_dict[entry_id]["description"] = match.group("desc")
-                shootings_dict[entry_id]["refs"] = get_refs(match)
-            else:
-                # This is a new entry.
-                [city, state] = get_location(match.group("loc"), ymd)
-                entry_id = create_id(ymd, city, state, shootings_dict)
-                coords = get_coords(None, city, state, interactive=True)
-                killed = int(match.group("killed"))
-                injured = int(match.group("injured"))
-                total = int(match.group("total"))
-                if killed + injured != total:
-                    print("Total number of victims doesn't add up ({} killed, {} injured, {} total). Update to {}?".format(killed, injured, total, killed + injured))
-                    confirm = input("['y' to confirm, any other character if not]: ")
-                    if confirm in ['y', 'Y']:
-                        total = killed + injured
-                rounded_coords = round_coords(coords)
-                shootings_dict[entry_id] = {
-                    "date": ymd,
-                    "state": state,
-                    "city": city,
-                    "street": None,
-                    "wikilink_target": match.group("wikilink_target"),
-                    "killed": killed,
-                    "injured": injured,
-                    "total": total,
-                    "lat": rounded_coords["lat"] if rounded_coords else None,
-                    "lon": rounded_coords["lon"] if rounded_coords else None,
-                    "description": match.group("desc").strip(),
-                    "refs": get_refs(match)
-                }
-
-    with open(YEAR + ".json", "w", encoding="utf-8") as shootings_json_file:
-        json.dump(shootings_dict, shootings_json_file, indent=2, sort_keys=True)
+    last_checkpoint = time.monotonic()
+    with open(wikitext, encoding='utf-8') as infile, metrics.stage("merge") as merge_stage:
+        try:
+            for row_number, row in enumerate(metrics.timed_iter("tokenize", iter_rows(infile))):
+                if row_number < rows_done:
+                    continue
+                parsed_date = datetime.strptime(row["date"], "%B %d, %Y")
+                ymd = parsed_date.strftime("%Y%m%d")
+                merge_row(ymd, row, shootings_dict, index, geocoder, queue)
+                rows_done = row_number + 1
+                merge_stage["rows"] = rows_done
+                if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                    save_checkpoint()
+                    last_checkpoint = time.monotonic()
+        except (KeyboardInterrupt, EOFError):
+            save_checkpoint()
+            print("\nSaved progress after {} rows. Run again to resume.".format(rows_done))
+            raise
+
+    if queue:
+        queue.save(review_path)
+        if queue.conflicts:
+            print("{} conflicts need review in {}. Fill in each 'decision', then run with 'resolve'.".format(
+                len(queue.conflicts), review_path))
+    return shootings_dict
+
+
+def prompt_decision(conflict):
+    print(conflict["message"])
+    if conflict["proposed"] is not None:
+        print("Proposed: {}".format(conflict["proposed"]))
+    return input("Decision ('accept', 'reject', or a value; leave blank to skip): ").strip() or None
+
+
+def resolve(shootings_dict, geocoder, year, interactive=False):
+    """Apply the decisions filled in to the review file. Conflicts that are still undecided (or whose decisions
+    couldn't be applied) stay in the file. With --interactive, prompt for each undecided conflict."""
+    review_path = REVIEW_FILE.format(year=year)
+    queue = ReviewQueue.load(review_path)
+    index = ShootingIndex(shootings_dict)
+    remaining = ReviewQueue()
+    applied = 0
+    for number, conflict in enumerate(queue.conflicts):
+        if conflict["decision"] is None and interactive:
+            try:
+                conflict["decision"] = prompt_decision(conflict)
+            except (KeyboardInterrupt, EOFError):
+                # Keep what's been applied so far, and leave the rest for next time
+                remaining.conflicts.extend(queue.conflicts[number:])
+                print()
+                break
+        if conflict["decision"] is None:
+            remaining.conflicts.append(conflict)
+        elif apply_decision(conflict, shootings_dict, index, geocoder, remaining):
+            applied += 1
+        else:
+            print("Couldn't apply decision '{}': {}".format(conflict["decision"], conflict["message"]))
+            remaining.conflicts.append(dict(conflict, decision=None))
+    remaining.save(review_path)
+    print("Applied {} decisions; {} conflicts left in {}.".format(applied, len(remaining.conflicts), review_path))
+    return shootings_dict
+
+
+def main(argv=None, geocoder=None, store=None):
+    args = parse_arguments(argv)
+    with instrumentation.run("parse_wikicode", args.year, profile=args.profile):
+        merge_or_resolve(args, geocoder, store)
+
+
+def merge_or_resolve(args, geocoder=None, store=None):
+    """Merge the wikitext or resolve the review file, and save the result to the store."""
+    # Load existing data
+    owns_store = store is None
+    if owns_store:
+        store = open_store()
+    with metrics.stage("load"):
+        shootings_dict = store.load(args.year)
+    if not shootings_dict:
+        raise Exception("This is meant to be run after parse_csv.py, and expects entries for {} to be available."
+                        .format(args.year))
+    owns_geocoder = geocoder is None
+    if owns_geocoder:
+        geocoder = Geocoder(endpoint=args.endpoint, rate=args.rate, cache=None if args.no_cache else GeocodeCache(),
+                            gazetteer=open_gazetteer())
+
+    if args.action == "resolve":
+        shootings_dict = resolve(shootings_dict, geocoder, args.year, args.interactive)
+    else:
+        shootings_dict = merge(shootings_dict, geocoder, args.wikitext, args.year, args.batch)
+    if owns_geocoder:
+        geocoder.close()
+
+    with metrics.stage("save"):
+        store.save(args.year, shootings_dict)
+    if owns_store:
+        store.close()
+    if args.action == "merge":
+        remove_checkpoint(args.year)
+
 
 if __name__ == "__main__":
     main()
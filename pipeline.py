@@ -0,0 +1,179 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+from buildcache import BuildCache, code_hash, file_hash, key, store_hash
+from constants import (YEAR, YEAR_WIKITEXT_FILE, NOMINATIM_ENDPOINT, GEOCODE_RATE, GEOCODE_WORKERS, GAZETTEER_FILE,
+                       CLUSTER_GRID, WATCH_INTERVAL)
+from gazetteer import open_gazetteer
+from generate_wikicode import check_format, output_paths, write_outputs
+from geocache import GeocodeCache
+from geocoder import Geocoder
+import instrumentation
+from instrumentation import metrics
+import os
+from parse_csv import read_csv, print_changes
+from parse_wikicode import merge, remove_checkpoint
+from storage import open_store
+import time
+import traceback
+
+# The modules each stage's output depends on. constants.py holds the templates and the CSV column names.
+CSV_STAGE_CODE = ["parse_csv", "geocoder", "gazetteer", "records", "constants"]
+MERGE_STAGE_CODE = ["parse_wikicode", "geocoder", "gazetteer", "records", "constants"]
+RENDER_STAGE_CODE = ["generate_wikicode", "records", "constants"]
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-y", "--year", help="year of the dataset to process", default=YEAR)
+    parser.add_argument("-w", "--wikitext", help="file containing the body of the wikitable (default: YEAR_wikitext.txt)")
+    parser.add_argument("-f", "--format", help="'table', 'map', 'both', 'clustered', or 'geojson'", default="both")
+    parser.add_argument("-b", "--batch", help="queue merge conflicts in the review file instead of prompting",
+                        action="store_true")
+    parser.add_argument("-i", "--interactive", help="input missing coordinates while script is running", action="store_true")
+    parser.add_argument("--skip-merge", help="don't merge in wikitext", action="store_true")
+    parser.add_argument("--full", help="ignore the render cache and render every entry", action="store_true")
+    parser.add_argument("--grid", help="degrees of latitude and longitude covered by each cell of the clustered map",
+                        type=float, default=CLUSTER_GRID)
+    parser.add_argument("--force", help="run every stage, even if its inputs haven't changed", action="store_true")
+    parser.add_argument("--watch", help="keep running, and rerun the stages affected whenever the CSV or wikitext "
+                                        "changes", action="store_true")
+    parser.add_argument("--no-cache", help="don't read or write the geocoding cache", action="store_true")
+    parser.add_argument("--no-gazetteer", help="don't look up cities in the offline gazetteer", action="store_true")
+    parser.add_argument("--endpoint", help="Nominatim-compatible search endpoint", default=NOMINATIM_ENDPOINT)
+    parser.add_argument("--rate", help="maximum geocoding requests per second", type=float, default=GEOCODE_RATE)
+    parser.add_argument("--workers", help="number of concurrent geocoding lookups", type=int, default=GEOCODE_WORKERS)
+    parser.add_argument("--profile", help="profile the run with cProfile", action="store_true")
+    args = parser.parse_args(argv)
+    check_format(args.format)
+    return args
+
+
+def run(year, geocoder, store, wikitext=None, fmt="both", batch=False, interactive=False, workers=GEOCODE_WORKERS,
+        full=False, grid=CLUSTER_GRID, force=False):
+    """Parse the year's CSV, merge in the wikitext, and render the outputs, keeping the entries in memory between
+    steps. The store is read once at the start and written once at the end, if anything changed. Stages whose inputs
+    haven't changed since the last run are skipped, along with the stages after them if nothing before them ran."""
+    build = BuildCache(year)
+    with metrics.stage("load"):
+        shootings_dict = store.load(year)
+        shootings_hash = store_hash(shootings_dict)
+    # Parsing and merging change the stored entries, so they can only be skipped if nothing else has changed them
+    unchanged = not force and build.store_unchanged(shootings_hash)
+
+    csv_path = year + ".csv"
+    csv_key = key(file_hash(csv_path), file_hash(GAZETTEER_FILE) if geocoder.gazetteer else None,
+                  code_hash(*CSV_STAGE_CODE))
+    # Entries without coordinates are looked up again on every run, in case the lookup succeeds this time
+    if unchanged and build.fresh("parse_csv", csv_key) and all(shooting.lat for shooting in shootings_dict.values()):
+        skip_stage("parse_csv", csv_path)
+    else:
+        unchanged = False
+        old_shootings_dict = shootings_dict
+        shootings_dict, counts, removed = read_csv(csv_path, old_shootings_dict, geocoder, workers, interactive, year)
+        if old_shootings_dict:
+            print_changes(counts, removed)
+        build.update("parse_csv", csv_key)
+
+    merge_key = key(file_hash(wikitext) if wikitext else None, batch, code_hash(*MERGE_STAGE_CODE))
+    if unchanged and build.fresh("merge", merge_key):
+        skip_stage("merge", wikitext)
+    else:
+        unchanged = False
+        if wikitext and os.path.exists(wikitext):
+            shootings_dict = merge(shootings_dict, geocoder, wikitext, year, batch)
+        elif wikitext:
+            print("No wikitext found at {}, skipping merge.".format(wikitext))
+        build.update("merge", merge_key)
+
+    if not unchanged:
+        shootings_hash = store_hash(shootings_dict)
+    # Rendering only depends on the entries, so it can be skipped whenever they come out the same as last time
+    outputs = output_paths(year, fmt)
+    render_key = key(shootings_hash, fmt, grid, code_hash(*RENDER_STAGE_CODE))
+    if not (force or full) and build.fresh("render", render_key, outputs):
+        skip_stage("render", ", ".join(outputs))
+    else:
+        write_outputs(shootings_dict, year, fmt, full, grid)
+        build.update("render", render_key, outputs)
+
+    if not unchanged:
+        with metrics.stage("save"):
+            store.save(year, shootings_dict)
+        remove_checkpoint(year)
+    build.save(shootings_hash)
+
+
+def skip_stage(stage, inputs):
+    metrics.increment("stages_skipped")
+    print("Skipping {}: nothing has changed since the last run ({}).".format(stage, inputs))
+
+
+def watch(args, wikitext, geocoder, store):
+    """Rerun the pipeline whenever the CSV or wikitext changes, until interrupted. Only the stages affected by the
+    change run again."""
+    paths = [args.year + ".csv"] + ([wikitext] if wikitext else [])
+    last_seen = None
+    while True:
+        seen = [os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in paths]
+        if seen != last_seen:
+            last_seen = seen
+            try:
+                run_once(args, wikitext, geocoder, store)
+            except Exception:
+                # The file may have been saved halfway through an edit; keep watching for the next change
+                traceback.print_exc()
+                print("The run failed. It will be retried when the inputs next change.")
+            print("Watching {} for changes. Press Ctrl+C to stop.".format(", ".join(paths)))
+        time.sleep(WATCH_INTERVAL)
+
+
+def run_once(args, wikitext, geocoder, store):
+    with instrumentation.run("pipeline", args.year, profile=args.profile):
+        run(args.year, geocoder, store, wikitext, args.format, args.batch, args.interactive, args.workers, args.full,
+            args.grid, args.force)
+
+
+def main(argv=None, geocoder=None, store=None):
+    args = parse_arguments(argv)
+    wikitext = None if args.skip_merge else args.wikitext or YEAR_WIKITEXT_FILE.format(year=args.year)
+    owns_store = store is None
+    if owns_store:
+        store = open_store()
+    owns_geocoder = geocoder is None
+    if owns_geocoder:
+        geocoder = Geocoder(endpoint=args.endpoint, rate=args.rate,
+                            cache=None if args.no_cache else GeocodeCache(), pool_size=args.workers,
+                            gazetteer=None if args.no_gazetteer else open_gazetteer())
+    try:
+        if args.watch:
+            watch(args, wikitext, geocoder, store)
+        else:
+            run_once(args, wikitext, geocoder, store)
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+    finally:
+        if owns_geocoder:
+            geocoder.close()
+        if owns_store:
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+class Shooting:
+    """One incident. Entries are kept in memory as these rather than dicts, and converted to and from dicts only when
+    they're stored. Entries merged in from the wikitext have no street or fingerprint."""
+
+    __slots__ = ["date", "state", "city", "street", "wikilink_target", "killed", "injured", "total", "lat", "lon",
+                 "description", "refs", "fingerprint"]
+
+    def __init__(self, date, state, city, street=None, wikilink_target=None, killed=0, injured=0, total=0, lat=None,
+                 lon=None, description=None, refs=None, fingerprint=None):
+        self.date = date
+        self.state = state
+        self.city = city
+        self.street = street
+        self.wikilink_target = wikilink_target
+        self.killed = killed
+        self.injured = injured
+        self.total = total
+        self.lat = lat
+        self.lon = lon
+        self.description = description
+        self.refs = refs if refs is not None else []
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self.__slots__}
+        if data["fingerprint"] is None:
+            del data["fingerprint"]
+        return data
+
+    def copy(self):
+        return Shooting(**{field: getattr(self, field) for field in self.__slots__})
+
+    def __eq__(self, other):
+        return isinstance(other, Shooting) and all(getattr(self, x) == getattr(other, x) for x in self.__slots__)
+
+    def __repr__(self):
+        return "Shooting({})".format(self.to_dict())
+
+
+def create_id(ymd, city, state, shootings_dict):
+    """Create a unique ID from the date, city, and state of the event. The increment at the end handles the possibility
+    of multiple shootings in one city on the same day."""
+    id_prefix = "{}_{}_{}".format(ymd, city.replace(' ', ''), state.replace(' ', ''))
+    incr = 0
+    while "{}_{}".format(id_prefix, incr) in shootings_dict:
+        incr += 1
+    return "{}_{}".format(id_prefix, incr)
+
+
+def to_dicts(shootings_dict):
+    return {shooting_id: shooting.to_dict() for shooting_id, shooting in shootings_dict.items()}
+
+
+def from_dicts(data):
+    return {shooting_id: Shooting.from_dict(shooting) for shooting_id, shooting in data.items()}
@@ -0,0 +1,67 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import os
+from storage import write_json_atomic
+
+
+class ReviewQueue:
+    """Conflicts found while merging, saved for a human to decide on later instead of prompting in the middle of a run.
+    Each conflict has a type, a human-readable message, the proposed resolution, and a decision that starts out as
+    None and is filled in during review."""
+
+    def __init__(self, conflicts=None):
+        self.conflicts = conflicts or []
+        # Conflicts by type and message, so add() doesn't have to scan the whole queue. Conflicts appended to the list
+        # directly are picked up on the next add().
+        self.by_key = {}
+        self.indexed = 0
+
+    def add(self, conflict_type, message, proposed, **details):
+        """Queue a conflict, unless the same one is already waiting for a decision."""
+        for conflict in self.conflicts[self.indexed:]:
+            self.by_key.setdefault((conflict["type"], conflict["message"]), []).append(conflict)
+        self.indexed = len(self.conflicts)
+        if any(conflict["decision"] is None for conflict in self.by_key.get((conflict_type, message), [])):
+            return
+        conflict = {
+            "type": conflict_type,
+            "message": message,
+            "proposed": proposed,
+            "decision": None
+        }
+        conflict.update(details)
+        self.conflicts.append(conflict)
+        print("Queued for review: " + message)
+
+    def undecided(self):
+        return [conflict for conflict in self.conflicts if conflict["decision"] is None]
+
+    def save(self, path):
+        if self.conflicts:
+            write_json_atomic(path, self.conflicts)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def load(path):
+        try:
+            with open(path, encoding="utf-8") as review_file:
+                return ReviewQueue(json.load(review_file))
+        except FileNotFoundError:
+            return ReviewQueue()
@@ -0,0 +1,256 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+from citations import expand_refs, intern_refs, is_ref_id
+from constants import STORAGE_BACKEND, SQLITE_STORE_FILE, JSON_STORE_FILE, YEAR
+import glob
+import json
+import os
+import re
+from records import Shooting, from_dicts, to_dicts
+import sqlite3
+
+
+def write_json_atomic(path, data, indent=2):
+    """Write JSON to a temporary file and move it into place, so an interrupted write never leaves a truncated file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as outfile:
+        json.dump(data, outfile, indent=indent, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def compact(shooting):
+    return json.dumps(shooting.to_dict(), separators=(",", ":"), sort_keys=True)
+
+
+class JsonStore:
+    """Stores each year's entries in an indented YEAR.json file. Every change rewrites the whole year. Entries keep
+    their refs in full, so YEAR.json stands on its own."""
+
+    def __init__(self, path=JSON_STORE_FILE):
+        self.path = path
+
+    def load(self, year=None):
+        """Load one year's entries, or every year's if no year is given."""
+        if year is None:
+            paths = sorted(glob.glob(self.path.format(year="[0-9]" * 4)))
+        else:
+            paths = [self.path.format(year=year)]
+        shootings_dict = {}
+        for path in paths:
+            try:
+                with open(path, encoding="utf-8") as shootings_json_file:
+                    shootings_dict.update(from_dicts(json.load(shootings_json_file)))
+            except FileNotFoundError:
+                pass
+        return shootings_dict
+
+    def save(self, year, shootings_dict):
+        """Replace a year's entries."""
+        write_json_atomic(self.path.format(year=year), to_dicts(shootings_dict))
+
+    def upsert(self, shootings_dict):
+        """Add or update entries, leaving the rest of their year untouched."""
+        for year in {shooting.date[:4] for shooting in shootings_dict.values()}:
+            existing = self.load(year)
+            existing.update({k: v for k, v in shootings_dict.items() if v.date[:4] == year})
+            self.save(year, existing)
+
+    def load_ids(self, shooting_ids):
+        """Load the entries with the given IDs, skipping any that don't exist."""
+        shootings_dict = {}
+        for year in {shooting_id[:4] for shooting_id in shooting_ids}:
+            existing = self.load(year)
+            shootings_dict.update({k: existing[k] for k in shooting_ids if k in existing})
+        return shootings_dict
+
+    def delete(self, shooting_ids):
+        for year in {shooting_id[:4] for shooting_id in shooting_ids}:
+            existing = self.load(year)
+            for shooting_id in shooting_ids:
+                existing.pop(shooting_id, None)
+            self.save(year, existing)
+
+    def close(self):
+        pass
+
+
+class SqliteStore:
+    """Stores entries as compact JSON, one row per entry, in a SQLite database. Saving a year only writes the entries
+    that changed, in a single transaction, so a crash mid-write leaves the previous version intact. The first time a
+    year is loaded, it's imported from YEAR.json if that exists. Entries hold the IDs of their refs, and each ref is
+    stored once in the citations table."""
+
+    def __init__(self, path=SQLITE_STORE_FILE, json_path=JSON_STORE_FILE):
+        self.json_path = json_path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS shootings (id TEXT PRIMARY KEY, year TEXT NOT NULL, "
+                          "data TEXT NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS shootings_year ON shootings (year)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS imported_years (year TEXT PRIMARY KEY, mtime REAL)")
+        if "mtime" not in [column[1] for column in self.conn.execute("PRAGMA table_info(imported_years)")]:
+            self.conn.execute("ALTER TABLE imported_years ADD COLUMN mtime REAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS citations (id TEXT PRIMARY KEY, ref TEXT NOT NULL)")
+        self.conn.commit()
+        self.citations = {}
+        self.warned_years = set()
+
+    def encode(self, shootings_dict):
+        """Turn entries into (id, year, data) rows, with their refs replaced by IDs. Refs that weren't in the citations
+        table when they were loaded are inserted into it, in the caller's transaction."""
+        rows = []
+        added = []
+        for shooting_id, shooting in shootings_dict.items():
+            entry = shooting.to_dict()
+            added.extend(intern_refs(entry, self.citations))
+            rows.append((shooting_id, shooting.date[:4], json.dumps(entry, separators=(",", ":"), sort_keys=True)))
+        self.conn.executemany("INSERT OR IGNORE INTO citations (id, ref) VALUES (?, ?)",
+                              [(citation_id, self.citations[citation_id]) for citation_id in added])
+        return rows
+
+    def decode(self, rows):
+        """Turn (id, data) rows back into entries, looking up their refs."""
+        entries = {shooting_id: json.loads(data) for shooting_id, data in rows}
+        missing = list({ref for entry in entries.values() for ref in entry.get("refs", [])
+                        if is_ref_id(ref) and ref not in self.citations})
+        for start in range(0, len(missing), 500):
+            batch = missing[start:start + 500]
+            self.citations.update(self.conn.execute("SELECT id, ref FROM citations WHERE id IN ({})".format(
+                ",".join("?" * len(batch))), batch))
+        return {shooting_id: Shooting.from_dict(expand_refs(entry, self.citations))
+                for shooting_id, entry in entries.items()}
+
+    def import_json(self, year):
+        """Import YEAR.json, if it exists and this year hasn't been imported before. After that, the database is the
+        source of truth, so a YEAR.json that's changed since (say, after a git pull) is only warned about."""
+        path = self.json_path.format(year=year)
+        imported = self.conn.execute("SELECT mtime FROM imported_years WHERE year = ?", (year,)).fetchone()
+        if imported:
+            if (imported[0] is not None and year not in self.warned_years and os.path.exists(path)
+                    and os.path.getmtime(path) > imported[0]):
+                self.warned_years.add(year)
+                print("Warning: {} has changed since it was imported, and the changes are being ignored. Run "
+                      "'python storage.py import -y {}' to replace the stored entries with it.".format(path, year))
+            return
+        if not os.path.exists(path):
+            return
+        with self.conn:
+            self.mark_imported(year)
+            shootings_dict = JsonStore(self.json_path).load(year)
+            if shootings_dict:
+                print("Importing {} entries from {}.".format(len(shootings_dict), self.json_path.format(year=year)))
+                self.conn.executemany("INSERT OR REPLACE INTO shootings (id, year, data) VALUES (?, ?, ?)",
+                                      self.encode(shootings_dict))
+
+    def mark_imported(self, year):
+        """Record that YEAR.json, as it is now, is reflected in the database."""
+        path = self.json_path.format(year=year)
+        self.conn.execute("INSERT OR REPLACE INTO imported_years (year, mtime) VALUES (?, ?)",
+                          (year, os.path.getmtime(path) if os.path.exists(path) else None))
+
+    def load(self, year=None):
+        """Load one year's entries, or every year's if no year is given."""
+        if year is None:
+            for path in glob.glob(self.json_path.format(year="[0-9]" * 4)):
+                match = re.search(r"\d{4}", os.path.basename(path))
+                if match:
+                    self.import_json(match.group(0))
+            rows = self.conn.execute("SELECT id, data FROM shootings ORDER BY id")
+        else:
+            self.import_json(year)
+            rows = self.conn.execute("SELECT id, data FROM shootings WHERE year = ? ORDER BY id", (year,))
+        return self.decode(rows.fetchall())
+
+    def save(self, year, shootings_dict):
+        """Replace a year's entries, writing only the ones that were added, changed, or removed."""
+        self.import_json(year)
+        existing = dict(self.conn.execute("SELECT id, data FROM shootings WHERE year = ?", (year,)))
+        with self.conn:
+            changed = [row for row in self.encode(shootings_dict) if existing.pop(row[0], None) != row[2]]
+            self.conn.executemany("INSERT OR REPLACE INTO shootings (id, year, data) VALUES (?, ?, ?)", changed)
+            self.conn.executemany("DELETE FROM shootings WHERE id = ?", [(k,) for k in existing])
+
+    def upsert(self, shootings_dict):
+        """Add or update entries, leaving the rest of their year untouched."""
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO shootings (id, year, data) VALUES (?, ?, ?)",
+                                  self.encode(shootings_dict))
+
+    def load_ids(self, shooting_ids):
+        """Load the entries with the given IDs, skipping any that don't exist."""
+        shooting_ids = list(shooting_ids)
+        for year in {shooting_id[:4] for shooting_id in shooting_ids}:
+            self.import_json(year)
+        rows = []
+        # Stay under SQLite's limit on the number of parameters in a query
+        for start in range(0, len(shooting_ids), 500):
+            batch = shooting_ids[start:start + 500]
+            rows.extend(self.conn.execute("SELECT id, data FROM shootings WHERE id IN ({})".format(
+                ",".join("?" * len(batch))), batch))
+        return self.decode(rows)
+
+    def delete(self, shooting_ids):
+        with self.conn:
+            self.conn.executemany("DELETE FROM shootings WHERE id = ?", [(k,) for k in shooting_ids])
+
+    def close(self):
+        self.conn.close()
+
+
+def open_store(backend=STORAGE_BACKEND):
+    if backend == "sqlite":
+        return SqliteStore()
+    if backend == "json":
+        return JsonStore()
+    raise Exception("Unrecognized storage backend {}. Expected either 'sqlite' or 'json'.".format(backend))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", help="'export' to write YEAR.json from the store, or 'import' to replace the "
+                                       "store's entries for YEAR with YEAR.json")
+    parser.add_argument("-y", "--year", help="year to export or import", default=YEAR)
+    args = parser.parse_args()
+    if args.action not in ['export', 'import']:
+        raise Exception("Unrecognized action {}. Expected either 'export' or 'import'.".format(args.action))
+    return args
+
+
+def main():
+    args = parse_arguments()
+    store = open_store()
+    if isinstance(store, JsonStore):
+        raise Exception("The JSON backend already stores entries in YEAR.json.")
+    if args.action == "export":
+        shootings_dict = store.load(args.year)
+        JsonStore().save(args.year, shootings_dict)
+        with store.conn:
+            store.mark_imported(args.year)
+        print("Exported {} entries to {}.".format(len(shootings_dict), JSON_STORE_FILE.format(year=args.year)))
+    else:
+        shootings_dict = JsonStore().load(args.year)
+        with store.conn:
+            store.mark_imported(args.year)
+        store.save(args.year, shootings_dict)
+        print("Imported {} entries from {}.".format(len(shootings_dict), JSON_STORE_FILE.format(year=args.year)))
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
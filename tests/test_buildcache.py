@@ -0,0 +1,68 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from buildcache import BuildCache, code_hash, file_hash, key, store_hash
+from records import Shooting
+
+
+def test_file_hash_changes_with_contents(tmp_path):
+    path = str(tmp_path / "2019.csv")
+    assert file_hash(path) is None
+    with open(path, "w") as csv_file:
+        csv_file.write("a")
+    first = file_hash(path)
+    with open(path, "w") as csv_file:
+        csv_file.write("b")
+    assert file_hash(path) not in (None, first)
+
+
+def test_store_hash_ignores_order_but_not_contents():
+    a = Shooting("20190105", "Ohio", "Akron", killed=1, total=1)
+    b = Shooting("20190106", "Ohio", "Dayton", killed=2, total=2)
+    assert store_hash({"a": a, "b": b}) == store_hash({"b": b, "a": a})
+    assert store_hash({"a": a, "b": b}) != store_hash({"a": a, "b": a})
+
+
+def test_code_hash_covers_the_modules():
+    assert code_hash("records") != code_hash("records", "constants")
+    assert code_hash("records") == code_hash("records")
+
+
+def test_fresh_needs_the_same_key_and_outputs(tmp_path):
+    output = str(tmp_path / "2019_map.txt")
+    with open(output, "w") as map_file:
+        map_file.write("map")
+    cache = BuildCache("2019", str(tmp_path / "{year}_build_cache.json"))
+    assert not cache.fresh("render", key("inputs"), [output])
+    cache.update("render", key("inputs"), [output])
+    assert cache.fresh("render", key("inputs"), [output])
+    assert not cache.fresh("render", key("other inputs"), [output])
+    with open(output, "w") as map_file:
+        map_file.write("edited")
+    assert not cache.fresh("render", key("inputs"), [output])
+
+
+def test_saved_cache_is_reloaded(tmp_path):
+    path = str(tmp_path / "{year}_build_cache.json")
+    cache = BuildCache("2019", path)
+    cache.update("parse_csv", key("csv"))
+    cache.save("entries")
+    reloaded = BuildCache("2019", path)
+    assert reloaded.fresh("parse_csv", key("csv"))
+    assert reloaded.store_unchanged("entries")
+    assert not reloaded.store_unchanged("other entries")
+    assert not BuildCache("2018", path).fresh("parse_csv", key("csv"))
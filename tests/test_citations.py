@@ -0,0 +1,95 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from citations import expand_refs, intern_refs, name_refs, parse_ref, ref_id
+from records import Shooting
+from storage import SqliteStore
+
+SOURCE = "<ref>{{cite web|url=https://example.com/|title=Shooting}}</ref>"
+
+
+def test_parse_ref():
+    citation = parse_ref('<ref name="wltx" group=note>{{cite web|url=https://wltx.com/a |title=Five shot}}</ref>')
+    assert citation["name"] == "wltx"
+    assert citation["attributes"] == "group=note"
+    assert citation["body"] == "{{cite web|url=https://wltx.com/a |title=Five shot}}"
+    assert parse_ref("<ref name=wltx />")["body"] is None
+
+
+def test_intern_and_expand_round_trip():
+    citations = {}
+    first = {"refs": [SOURCE, "<ref>other</ref>"]}
+    second = {"refs": [SOURCE]}
+    assert intern_refs(first, citations) == [ref_id(SOURCE), ref_id("<ref>other</ref>")]
+    assert intern_refs(second, citations) == []
+    assert second["refs"] == [ref_id(SOURCE)]
+    assert len(citations) == 2
+    assert expand_refs(first, citations)["refs"] == [SOURCE, "<ref>other</ref>"]
+    # Entries saved before refs were interned are read as they are
+    assert expand_refs({"refs": [SOURCE]}, {})["refs"] == [SOURCE]
+
+
+def test_name_refs_leaves_refs_used_once():
+    rows = ["Shot.<ref>a</ref>\n", "Shot.<ref name=\"b\">b</ref>\n"]
+    assert name_refs(rows) == rows
+
+
+def test_name_refs_defines_a_repeated_citation_once():
+    rows = name_refs(["A." + SOURCE, "B.<ref>other</ref>", "C." + SOURCE.replace("cite web", "cite\n  web")])
+    name = parse_ref(rows[0][2:])["name"]
+    assert name.startswith("ref")
+    assert rows == ['A.<ref name="{}">{{{{cite web|url=https://example.com/|title=Shooting}}}}</ref>'.format(name),
+                    "B.<ref>other</ref>", 'C.<ref name="{}" />'.format(name)]
+
+
+def test_name_refs_keeps_existing_names_and_attributes():
+    rows = name_refs(["A.<ref>a</ref>", 'B.<ref name="src" group="note">a</ref>', 'C.<ref name=src group="note"/>',
+                      'D.<ref group="note">a</ref>'])
+    assert rows == ["A.<ref>a</ref>", 'B.<ref name="src" group="note">a</ref>', 'C.<ref name="src" group="note" />',
+                    'D.<ref name="src" group="note" />']
+
+
+def test_name_refs_redirects_reuses_of_merged_names():
+    rows = name_refs(['<ref name="x">a</ref>', '<ref name="y">a</ref>', '<ref name="y" />'])
+    assert rows == ['<ref name="x">a</ref>', '<ref name="x" />', '<ref name="x" />']
+
+
+def test_name_refs_keeps_different_bodies_apart():
+    rows = ["<ref>{{cite web|url=https://example.com/|access-date=1}}</ref>",
+            "<ref>{{cite web|url=https://example.com/|access-date=2}}</ref>"]
+    assert name_refs(rows) == rows
+
+
+def test_name_refs_is_stable():
+    rows = name_refs(["A." + SOURCE, "B." + SOURCE, 'C.<ref name="x">c</ref>', 'D.<ref name="x" />'])
+    assert name_refs(rows) == rows
+
+
+def test_sqlite_store_keeps_each_ref_once(tmp_path):
+    store = SqliteStore(str(tmp_path / "shootings.sqlite"), str(tmp_path / "{year}.json"))
+    entries = {
+        "20190105_Akron_Ohio_0": Shooting("20190105", "Ohio", "Akron", refs=[SOURCE, "<ref>a</ref>"]),
+        "20190106_Dayton_Ohio_0": Shooting("20190106", "Ohio", "Dayton", refs=[SOURCE])
+    }
+    store.save("2019", entries)
+    assert store.conn.execute("SELECT COUNT(*) FROM citations").fetchone()[0] == 2
+    assert SOURCE not in store.conn.execute("SELECT data FROM shootings WHERE id = ?",
+                                            ("20190106_Dayton_Ohio_0",)).fetchone()[0]
+    store.close()
+    store = SqliteStore(str(tmp_path / "shootings.sqlite"), str(tmp_path / "{year}.json"))
+    assert store.load("2019") == entries
+    store.close()
@@ -0,0 +1,73 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from constants import CLUSTER_MAX_MARKSIZE, CLUSTER_MIN_MARKSIZE
+from generate_wikicode import cluster, marker_size, to_feature, write_outputs
+import json
+from records import Shooting
+
+
+def make_shooting(city, lat, lon, killed=1, injured=3, date="20190105", **fields):
+    return Shooting(date, "Ohio", city, street="1 Main St", killed=killed, injured=injured, total=killed + injured,
+                    lat=lat, lon=lon, description="People were shot.", refs=["<ref>{}</ref>".format(city)], **fields)
+
+
+def test_cluster_bins_entries_by_grid_cell():
+    shootings_dict = {"a": make_shooting("Akron", 41.2, -81.6), "b": make_shooting("Akron", 41.8, -81.2, killed=2),
+                      "c": make_shooting("Dayton", 39.7, -84.2), "d": make_shooting("Nowhere", None, None)}
+    clusters = sorted(cluster(shootings_dict), key=lambda x: x["lat"])
+    assert [(x["count"], x["killed"], x["total"]) for x in clusters] == [(1, 1, 4), (2, 3, 9)]
+    assert (clusters[1]["lat"], clusters[1]["lon"]) == (41.5, -81.4)
+    assert clusters[1]["places"] == {"Akron, Ohio": 2}
+    assert len(cluster(shootings_dict, grid=0.5)) == 3
+
+
+def test_marker_size_scales_area_with_victims():
+    assert marker_size(0, 0) == CLUSTER_MIN_MARKSIZE
+    assert marker_size(40, 40) == CLUSTER_MAX_MARKSIZE
+    assert marker_size(10, 40) == round((CLUSTER_MIN_MARKSIZE + CLUSTER_MAX_MARKSIZE) / 2)
+    assert marker_size(0, 40) == CLUSTER_MIN_MARKSIZE
+
+
+def test_to_feature_puts_longitude_first():
+    feature = to_feature("a", make_shooting("Akron", 41.08, -81.51, wikilink_target="2019 Akron shooting|"))
+    assert feature["geometry"] == {"type": "Point", "coordinates": [-81.51, 41.08]}
+    assert feature["properties"]["date"] == "2019-01-05"
+    assert feature["properties"]["article"] == "2019 Akron shooting"
+
+
+def test_write_outputs_diffs_against_the_last_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shootings_dict = {"a": make_shooting("Akron", 41.08, -81.51), "b": make_shooting("Dayton", 39.76, -84.19)}
+    write_outputs(shootings_dict, "2019", "both")
+    assert not (tmp_path / "2019_diff.txt").exists()
+    with open("2019_render_cache.json", encoding="utf-8") as cache_file:
+        assert sorted(json.load(cache_file)) == ["a", "b"]
+
+    shootings_dict = {"a": make_shooting("Akron", 41.08, -81.51, killed=2),
+                      "c": make_shooting("Toledo", 41.65, -83.54, date="20190106")}
+    write_outputs(shootings_dict, "2019", "both")
+    diff = (tmp_path / "2019_diff.txt").read_text(encoding="utf-8")
+    assert "Changed a:\n" in diff
+    assert "Added c:\n" in diff
+    assert "Removed b:\n" in diff
+    assert "- |{{Dts|January 5, 2019}}\n|[[Dayton, Ohio]]" in diff
+    assert "Akron" in (tmp_path / "2019_table.txt").read_text(encoding="utf-8")
+    assert "Dayton" not in (tmp_path / "2019_map.txt").read_text(encoding="utf-8")
+
+    write_outputs(shootings_dict, "2019", "both")
+    assert (tmp_path / "2019_diff.txt").read_text(encoding="utf-8") == ""
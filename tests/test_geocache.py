@@ -0,0 +1,72 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import geocache
+from geocache import GeocodeCache, normalize_query
+
+
+def test_normalize_query_ignores_case_spacing_and_block_of():
+    expected = normalize_query("5000 Main St.", "Chicago", "Illinois")
+    assert normalize_query("5000 block of Main St.", "Chicago", "Illinois") == expected
+    assert normalize_query("5000 Block of Main St.", "chicago", "ILLINOIS") == expected
+    assert normalize_query("5000  main st.", " Chicago ", "Illinois") == expected
+
+
+def test_normalize_query_drops_parentheticals_from_city():
+    assert normalize_query("", "Littleton (Highlands Ranch)", "Colorado") == normalize_query(None, "Littleton",
+                                                                                             "Colorado")
+
+
+def test_cache_stores_hits_and_misses(tmp_path):
+    cache = GeocodeCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get("1 Main St", "Akron", "Ohio") == (False, None)
+    cache.set("1 Main St", "Akron", "Ohio", {"lat": "41.08", "lon": "-81.51"})
+    cache.set("", "Nowhere", "Ohio", None)
+    assert cache.get("1 main st", "Akron", "Ohio") == (True, {"lat": "41.08", "lon": "-81.51"})
+    assert cache.get("", "Nowhere", "Ohio") == (True, None)
+    cache.close()
+
+
+def test_cache_expires_entries(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(geocache.time, "time", lambda: now[0])
+    cache = GeocodeCache(str(tmp_path / "cache.sqlite"), ttl=100, negative_ttl=10)
+    cache.set("1 Main St", "Akron", "Ohio", {"lat": "41.08", "lon": "-81.51"})
+    cache.set("", "Nowhere", "Ohio", None)
+    now[0] += 50
+    assert cache.get("1 Main St", "Akron", "Ohio")[0]
+    assert cache.get("", "Nowhere", "Ohio") == (False, None)
+    now[0] += 100
+    assert cache.get("1 Main St", "Akron", "Ohio") == (False, None)
+    cache.close()
+
+
+def test_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(geocache.time, "time", lambda: now[0])
+    cache = GeocodeCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    for city in ["Akron", "Dayton", "Toledo"]:
+        now[0] += 1
+        cache.set("", city, "Ohio", {"lat": "1", "lon": "2"})
+        if city == "Dayton":
+            now[0] += 1
+            cache.get("", "Akron", "Ohio")
+    cache.evict()
+    assert cache.get("", "Akron", "Ohio")[0]
+    assert cache.get("", "Toledo", "Ohio")[0]
+    assert cache.get("", "Dayton", "Ohio") == (False, None)
+    cache.close()
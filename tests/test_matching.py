@@ -0,0 +1,62 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from matching import ShootingIndex, city_similarity, is_certain_match, is_certain_mismatch
+from records import Shooting
+
+
+def index(*shootings):
+    return ShootingIndex({"2019010{}".format(i): shooting for i, shooting in enumerate(shootings)})
+
+
+def test_rank_uses_aliases_and_abbreviations():
+    shootings = index(Shooting("20190105", "Colorado", "Littleton (Highlands Ranch)", killed=1, injured=8),
+                      Shooting("20190105", "Missouri", "St. Louis", killed=0, injured=4),
+                      Shooting("20190106", "Missouri", "Saint Louis"))
+    assert shootings.rank("20190105", "Highlands Ranch", "Colorado", 1, 8) == [(1.0, "20190100", True)]
+    ranked = index(Shooting("20190105", "Missouri", "St. Louis", killed=0, injured=4)).rank(
+        "20190105", "Saint Louis", "Missouri", 0, 5)
+    assert ranked == [(1.0, "20190100", False)]
+
+
+def test_rank_falls_back_to_the_city_when_the_state_differs():
+    ranked = index(Shooting("20190105", "Washington, D.C.", "Washington")).rank(
+        "20190105", "Washington", "District of Columbia", 0, 0)
+    assert [x[1] for x in ranked] == ["20190100"]
+
+
+def test_a_city_containing_the_other_needs_the_victim_counts_to_match():
+    assert city_similarity("chicago", "chicago heights") < 0.85
+    shootings = index(Shooting("20190105", "Illinois", "Chicago Heights", killed=0, injured=4))
+    assert not is_certain_match(shootings.rank("20190105", "Chicago", "Illinois", 2, 5))
+    assert is_certain_match(shootings.rank("20190105", "Chicago", "Illinois", 0, 4))
+    springfield = index(Shooting("20190105", "Massachusetts", "West Springfield", killed=0, injured=4))
+    assert not is_certain_match(springfield.rank("20190105", "Springfield", "Massachusetts", 1, 3))
+
+
+def test_is_certain_match_needs_a_clear_best_candidate():
+    assert not is_certain_match([])
+    assert is_certain_match([(0.95, "a", False)])
+    assert not is_certain_match([(0.95, "a", False), (0.9, "b", False)])
+    assert is_certain_match([(0.95, "a", False), (0.6, "b", True)])
+    assert not is_certain_match([(0.4, "a", True)])
+
+
+def test_is_certain_mismatch():
+    assert is_certain_mismatch((0.2, "a", False))
+    assert not is_certain_mismatch((0.2, "a", True))
+    assert not is_certain_mismatch((0.5, "a", False))
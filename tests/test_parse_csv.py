@@ -0,0 +1,153 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import csv
+from parse_csv import iter_csv_rows, map_columns, stream_csv, update_entry
+import pytest
+from records import Shooting
+from storage import SqliteStore
+
+HEADER = ["Incident ID", "Address", "Victims Injured", "State", "City Or County", "Incident Date", "Victims Killed"]
+ROWS = [
+    ["1", "1 Main St", "3", "Ohio", "Akron", "2019-01-05", "1"],
+    ["2", "2 Main St", "4", "Ohio", "Dayton", "2019-01-05", "0"],
+    ["3", "3 Main St", "1", "Texas", "Dallas", "2019-01-06", "0"],
+    ["4", "4 Main St", "2", "Ohio", "Akron", "2018-12-31", "2"],
+    ["5", "5 Main St", "4", "Ohio", "Toledo", "2019-01-07", "1"]
+]
+
+
+def make_row(**fields):
+    row = {"date": "20190105", "state": "Ohio", "city": "Akron", "street": "1 Main St", "killed": 1, "injured": 3,
+           "fingerprint": "abc"}
+    row.update(fields)
+    return row
+
+
+def make_shooting(**fields):
+    shooting = Shooting("20190105", "Ohio", "Akron", street="1 Main St", killed=1, injured=3, total=4, lat=41.08,
+                        lon=-81.51, description="Merged from the wikitext.", fingerprint="abc")
+    for field, value in fields.items():
+        setattr(shooting, field, value)
+    return shooting
+
+
+def test_new_row_is_added_and_looked_up():
+    shooting, status, needs_lookup = update_entry(make_row(), None)
+    assert status == "added"
+    assert needs_lookup
+    assert shooting.total == 4
+    assert shooting.fingerprint == "abc"
+
+
+def test_unchanged_row_keeps_the_entry():
+    old = make_shooting()
+    shooting, status, needs_lookup = update_entry(make_row(), old)
+    assert status == "unchanged"
+    assert not needs_lookup
+    assert shooting == old
+    assert shooting is not old
+
+
+def test_unchanged_row_without_coordinates_is_looked_up_again():
+    shooting, status, needs_lookup = update_entry(make_row(), make_shooting(lat=None, lon=None))
+    assert status == "unchanged"
+    assert needs_lookup
+
+
+def test_changed_numbers_keep_the_location():
+    shooting, status, needs_lookup = update_entry(make_row(injured=4, fingerprint="def"), make_shooting())
+    assert status == "changed"
+    assert not needs_lookup
+    assert (shooting.lat, shooting.total) == (41.08, 5)
+    assert shooting.description == "Merged from the wikitext."
+
+
+def test_changed_street_clears_the_location():
+    shooting, status, needs_lookup = update_entry(make_row(street="2 Main St", fingerprint="def"), make_shooting())
+    assert status == "changed"
+    assert needs_lookup
+    assert shooting.lat is None and shooting.lon is None
+
+
+def test_entries_without_fingerprints_are_compared_field_by_field():
+    old = make_shooting(fingerprint=None)
+    assert update_entry(make_row(), old)[1] == "unchanged"
+    assert update_entry(make_row(killed=2), old)[1] == "changed"
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+
+class FakeGeocoder:
+    def __init__(self):
+        self.streets = []
+
+    def geocode(self, street, city, state):
+        self.streets.append(street)
+        return {"lat": "41.0", "lon": "-81.0"}
+
+
+class InterruptingStore(SqliteStore):
+    """Stops the stream partway through, while the second chunk is being written."""
+    chunks = 0
+
+    def upsert(self, shootings_dict):
+        self.chunks += 1
+        if self.chunks == 2:
+            raise KeyboardInterrupt
+        super().upsert(shootings_dict)
+
+
+def test_map_columns_finds_columns_by_header():
+    columns = map_columns([" incident date", "State", "City Or County", "Address", "# Killed", "# Injured", "Notes"])
+    assert columns == {"date": 0, "state": 1, "city": 2, "street": 3, "killed": 4, "injured": 5}
+    assert map_columns(HEADER)["killed"] == 6
+    with pytest.raises(Exception, match="no column for the injured"):
+        map_columns(["Incident Date", "State", "City Or County", "Address", "# Killed"])
+
+
+def test_iter_csv_rows_filters(tmp_path):
+    path = str(tmp_path / "export.csv")
+    write_csv(path, ROWS)
+    assert [number for number, _ in iter_csv_rows(path)] == [1, 2, 3, 4, 5]
+    assert [number for number, _ in iter_csv_rows(path, year="2019")] == [1, 2, 3, 5]
+    assert [number for number, _ in iter_csv_rows(path, min_victims=5)] == [5]
+    assert [number for number, _ in iter_csv_rows(path, states=["texas"])] == [3]
+    assert [number for number, _ in iter_csv_rows(path, skip=3)] == [4, 5]
+    row = next(iter_csv_rows(path))[1]
+    assert (row["date"], row["city"], row["killed"], row["injured"]) == ("20190105", "Akron", 1, 3)
+
+
+def test_stream_csv_resumes_after_the_last_chunk(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_csv("export.csv", [row for row in ROWS if row[5].startswith("2019")])
+    store = InterruptingStore(str(tmp_path / "shootings.sqlite"), str(tmp_path / "{year}.json"))
+    geocoder = FakeGeocoder()
+    with pytest.raises(KeyboardInterrupt):
+        stream_csv("export.csv", store, geocoder, chunk_size=2, workers=1)
+    assert len(store.load("2019")) == 2
+    counts = stream_csv("export.csv", store, geocoder, chunk_size=2, workers=1)
+    assert geocoder.streets == ["1 Main St", "2 Main St", "3 Main St", "5 Main St", "3 Main St", "5 Main St"]
+    assert counts == {"added": 4, "changed": 0, "unchanged": 0}
+    assert sorted(x.city for x in store.load("2019").values()) == ["Akron", "Dallas", "Dayton", "Toledo"]
+    assert not (tmp_path / "export_progress.json").exists()
+    store.close()
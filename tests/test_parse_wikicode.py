@@ -0,0 +1,85 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from buildcache import file_hash, key, store_hash
+import json
+from parse_wikicode import iter_rows, load_checkpoint, merge, split_refs
+from records import Shooting, to_dicts
+
+ROWS = """|-
+|{{Dts|January 1, 2019}}
+|[[Columbia, South Carolina|Columbia, South Carolina]]
+|0
+|5
+|'''5'''
+|Five people were shot.<ref>{{cite news
+|title=Shooting
+|-
+|url=https://example.com/}}</ref><ref name="wltx" />
+|-
+|{{dts|January 3, 2019}}
+|[[Atlanta]], [[Georgia (U.S. state)|Georgia]]
+|1
+|3
+|'''4'''
+|Four people were shot<ref>{{cite web|url=https://example.com/a}}</ref> outside a bar.
+|-
+"""
+
+
+def test_iter_rows_reads_refs_that_span_lines():
+    rows = list(iter_rows(ROWS.splitlines(True)))
+    assert len(rows) == 2
+    first = rows[0]
+    assert first["date"] == "January 1, 2019"
+    assert first["wikilink_target"] == "Columbia, South Carolina|"
+    assert first["loc"] == "Columbia, South Carolina"
+    assert (first["killed"], first["injured"], first["total"]) == ("0", "5", "5")
+    assert first["desc"] == "Five people were shot."
+    assert first["refs"] == ["<ref>{{cite news\n|title=Shooting\n|-\n|url=https://example.com/}}</ref>",
+                             '<ref name="wltx" />']
+
+
+def test_iter_rows_keeps_the_text_of_several_links():
+    second = list(iter_rows(ROWS.splitlines(True)))[1]
+    assert second["wikilink_target"] is None
+    assert second["loc"] == "Atlanta, Georgia"
+
+
+def test_split_refs_only_takes_refs_at_the_end():
+    assert split_refs("Shot.<ref>a</ref> <ref name=b/>") == ("Shot.", ["<ref>a</ref>", "<ref name=b/>"])
+    assert split_refs("Shot<ref>a</ref> at a bar.") == ("Shot<ref>a</ref> at a bar.", [])
+    assert split_refs("Shot<ref>a</ref> at a bar.<ref>b</ref>") == ("Shot<ref>a</ref> at a bar.", ["<ref>b</ref>"])
+    assert split_refs("No refs.") == ("No refs.", [])
+
+
+def test_merge_ignores_a_checkpoint_from_before_the_entries_changed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open("wikitext.txt", "w") as wikitext_file:
+        wikitext_file.write("")
+    shootings_dict = {"2019010501": Shooting("20190105", "Ohio", "Akron", killed=0, total=0)}
+    with open("2019_checkpoint.json", "w") as checkpoint_file:
+        json.dump({"wikitext": "wikitext.txt", "inputs": key(file_hash("wikitext.txt"), store_hash(shootings_dict)),
+                   "rows": 0, "shootings": to_dicts(shootings_dict), "conflicts": []}, checkpoint_file)
+    assert load_checkpoint("2019_checkpoint.json", "wikitext.txt",
+                           key(file_hash("wikitext.txt"), store_hash(shootings_dict)))
+    updated = {"2019010501": Shooting("20190105", "Ohio", "Akron", killed=99, total=99)}
+    assert merge(updated, None, "wikitext.txt", "2019")["2019010501"].killed == 99
+    with open("wikitext.txt", "w") as wikitext_file:
+        wikitext_file.write("|-\n")
+    assert load_checkpoint("2019_checkpoint.json", "wikitext.txt",
+                           key(file_hash("wikitext.txt"), store_hash(shootings_dict))) is None
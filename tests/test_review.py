@@ -0,0 +1,47 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from review import ReviewQueue
+
+
+def test_add_skips_conflicts_already_waiting_for_a_decision():
+    queue = ReviewQueue()
+    queue.add("field", "Totals don't match.", 4, entry_id="a")
+    queue.add("field", "Totals don't match.", 4, entry_id="a")
+    assert len(queue.conflicts) == 1
+    queue.conflicts[0]["decision"] = "accept"
+    queue.add("field", "Totals don't match.", 4, entry_id="a")
+    assert len(queue.conflicts) == 2
+    assert len(queue.undecided()) == 1
+
+
+def test_add_sees_conflicts_appended_directly():
+    queue = ReviewQueue()
+    queue.conflicts.append({"type": "field", "message": "Totals don't match.", "proposed": 4, "decision": None})
+    queue.add("field", "Totals don't match.", 4, entry_id="a")
+    assert len(queue.conflicts) == 1
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "2019_review.json")
+    queue = ReviewQueue()
+    queue.add("duplicate", "a and b may be duplicates.", None, entry_ids=["a", "b"])
+    queue.save(path)
+    loaded = ReviewQueue.load(path)
+    assert loaded.conflicts == queue.conflicts
+    ReviewQueue().save(path)
+    assert ReviewQueue.load(path).conflicts == []
@@ -0,0 +1,96 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+from records import Shooting
+from storage import JsonStore, SqliteStore
+
+
+def make_entries():
+    return {
+        "20190105_Akron_Ohio_0": Shooting("20190105", "Ohio", "Akron", street="1 Main St", killed=1, injured=3, total=4,
+                                          lat=41.08, lon=-81.51, refs=["<ref>a</ref>"], fingerprint="abc"),
+        "20190106_Dayton_Ohio_0": Shooting("20190106", "Ohio", "Dayton", killed=0, injured=4, total=4,
+                                           description="Four people were shot.", refs=["<ref>b</ref>"])
+    }
+
+
+def open_stores(tmp_path):
+    json_path = str(tmp_path / "{year}.json")
+    return JsonStore(json_path), SqliteStore(str(tmp_path / "shootings.sqlite"), json_path)
+
+
+def test_json_store_round_trip(tmp_path):
+    json_store, _ = open_stores(tmp_path)
+    json_store.save("2019", make_entries())
+    assert json_store.load("2019") == make_entries()
+    assert json_store.load("2018") == {}
+
+
+def test_sqlite_store_imports_year_json_once(tmp_path, capsys):
+    json_store, store = open_stores(tmp_path)
+    json_store.save("2019", make_entries())
+    assert store.load("2019") == make_entries()
+    assert "Importing 2 entries" in capsys.readouterr().out
+    store.delete(["20190106_Dayton_Ohio_0"])
+    assert list(store.load("2019")) == ["20190105_Akron_Ohio_0"]
+    assert "Importing" not in capsys.readouterr().out
+    store.close()
+
+
+def test_sqlite_store_imports_year_json_that_appears_later(tmp_path):
+    json_store, store = open_stores(tmp_path)
+    assert store.load("2019") == {}
+    json_store.save("2019", make_entries())
+    assert store.load("2019") == make_entries()
+    store.close()
+
+
+def test_sqlite_store_warns_when_year_json_changes(tmp_path, capsys):
+    json_store, store = open_stores(tmp_path)
+    json_store.save("2019", make_entries())
+    store.load("2019")
+    mtime = os.path.getmtime(json_store.path.format(year="2019"))
+    os.utime(json_store.path.format(year="2019"), (mtime + 10, mtime + 10))
+    store.load("2019")
+    assert "has changed since it was imported" in capsys.readouterr().out
+    store.close()
+
+
+def test_sqlite_store_save_load_round_trip(tmp_path):
+    _, store = open_stores(tmp_path)
+    entries = make_entries()
+    store.save("2019", entries)
+    entries["20190105_Akron_Ohio_0"].injured = 4
+    del entries["20190106_Dayton_Ohio_0"]
+    entries["20190107_Toledo_Ohio_0"] = Shooting("20190107", "Ohio", "Toledo", killed=4, total=4)
+    store.save("2019", entries)
+    store.close()
+    _, store = open_stores(tmp_path)
+    assert store.load("2019") == entries
+    assert store.load_ids(["20190107_Toledo_Ohio_0", "20190199_Missing_Ohio_0"]) == {
+        "20190107_Toledo_Ohio_0": entries["20190107_Toledo_Ohio_0"]}
+    store.close()
+
+
+def test_sqlite_store_upsert_leaves_the_rest_of_the_year(tmp_path):
+    _, store = open_stores(tmp_path)
+    store.save("2019", make_entries())
+    toledo = {"20190107_Toledo_Ohio_0": Shooting("20190107", "Ohio", "Toledo", killed=4, total=4)}
+    store.upsert(toledo)
+    assert store.load("2019") == dict(make_entries(), **toledo)
+    store.close()
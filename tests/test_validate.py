@@ -0,0 +1,55 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+from records import Shooting
+from validate import Points, check_bounds, find_near_duplicates, leave_one_out_medians
+
+
+def points(*entries):
+    return Points({"2019{:04d}".format(i): entry for i, entry in enumerate(entries)})
+
+
+def test_leave_one_out_medians_match_brute_force():
+    values = np.array([5.0, 1.0, 3.0, 3.0, 9.0, 2.0])
+    expected = [np.median(np.delete(values, i)) for i in range(len(values))]
+    assert np.allclose(leave_one_out_medians(values), expected)
+    assert np.allclose(leave_one_out_medians(values[:5]), [np.median(np.delete(values[:5], i)) for i in range(5)])
+
+
+def test_check_bounds_proposes_swapped_and_negated_coordinates():
+    problems = check_bounds(points(Shooting("20190105", "Ohio", "Akron", lat=41.08, lon=-81.52),
+                                   Shooting("20190105", "Ohio", "Akron", lat=-81.52, lon=41.08),
+                                   Shooting("20190105", "Ohio", "Akron", lat=41.08, lon=81.52),
+                                   Shooting("20190105", "Ohio", "Akron", lat=10.0, lon=10.0),
+                                   Shooting("20190105", "Ohio", "Akron")))
+    assert [(x["entry_id"], x["proposed"]) for x in problems] == [
+        ("20190001", "41.08,-81.52"), ("20190002", "41.08,-81.52"), ("20190003", None)]
+
+
+def test_find_near_duplicates_compares_neighboring_rows_far_from_the_meridian():
+    problems = find_near_duplicates(points(Shooting("20190105", "Alaska", "Nome", lat=60.0, lon=-170.0),
+                                           Shooting("20190105", "Alaska", "Nome", lat=60.008, lon=-170.0)))
+    assert [x["entry_ids"] for x in problems] == [["20190000", "20190001"]]
+
+
+def test_find_near_duplicates_needs_the_same_day_and_distance():
+    problems = find_near_duplicates(points(Shooting("20190105", "Ohio", "Akron", lat=41.08, lon=-81.52),
+                                           Shooting("20190106", "Ohio", "Akron", lat=41.08, lon=-81.52),
+                                           Shooting("20190105", "Ohio", "Akron", lat=41.10, lon=-81.52),
+                                           Shooting("20190105", "Ohio", "Akron")))
+    assert problems == []
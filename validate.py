@@ -0,0 +1,228 @@
+# Copyright (c) 2018-2019 Molly White
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+from constants import (YEAR, REVIEW_FILE, STATE_BOUNDS, STATE_BOUNDS_MARGIN, CITY_OUTLIER_KM, CITY_OUTLIER_MIN_ENTRIES,
+                       DUPLICATE_DISTANCE_KM)
+import instrumentation
+from instrumentation import metrics
+from matching import normalize_place
+import numpy as np
+from review import ReviewQueue
+from storage import open_store
+
+EARTH_RADIUS_KM = 6371.0
+# Length of a degree of latitude, and of longitude at the equator
+KM_PER_DEGREE = np.radians(EARTH_RADIUS_KM)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-y", "--year", help="year of the dataset to check", default=YEAR)
+    parser.add_argument("-a", "--all", help="check every year in the store at once", action="store_true")
+    parser.add_argument("-q", "--queue", help="add the problems to each year's review file", action="store_true")
+    return parser.parse_args(argv)
+
+
+class Points:
+    """The entries' coordinates and the fields they're checked against, as parallel arrays. Entries without
+    coordinates have NaN for lat and lon."""
+
+    def __init__(self, shootings_dict):
+        self.ids = np.array(list(shootings_dict.keys()), dtype=object)
+        shootings = list(shootings_dict.values())
+        self.lat = np.array([np.nan if x.lat is None else x.lat for x in shootings], dtype=float)
+        self.lon = np.array([np.nan if x.lon is None else x.lon for x in shootings], dtype=float)
+        self.states = np.array([x.state for x in shootings], dtype=object)
+        self.cities = np.array(["{}|{}".format(normalize_place(x.city), normalize_place(x.state))
+                                for x in shootings], dtype=object)
+        # Days since 1970, so they fit alongside the grid cell in a single integer key
+        self.dates = np.array(["{}-{}-{}".format(x.date[:4], x.date[4:6], x.date[6:]) for x in shootings],
+                              dtype="datetime64[D]").astype(np.int64)
+        self.located = ~(np.isnan(self.lat) | np.isnan(self.lon))
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between arrays of points."""
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def inside_bounds(lat, lon, bounds):
+    return ((lat >= bounds[:, 0] - STATE_BOUNDS_MARGIN) & (lat <= bounds[:, 1] + STATE_BOUNDS_MARGIN)
+            & (lon >= bounds[:, 2] - STATE_BOUNDS_MARGIN) & (lon <= bounds[:, 3] + STATE_BOUNDS_MARGIN))
+
+
+def check_bounds(points):
+    """Find entries whose coordinates are outside their state's bounding box. If swapping lat and lon, or flipping the
+    sign of the longitude, would put the point inside the state, that's proposed as the fix."""
+    states, inverse = np.unique(points.states, return_inverse=True)
+    bounds = np.array([STATE_BOUNDS.get(state, (np.nan,) * 4) for state in states], dtype=float)[inverse]
+    known = ~np.isnan(bounds[:, 0])
+    outside = points.located & known & ~inside_bounds(points.lat, points.lon, bounds)
+    swapped = outside & inside_bounds(points.lon, points.lat, bounds)
+    negated = outside & inside_bounds(points.lat, -points.lon, bounds)
+    problems = []
+    for i in np.flatnonzero(outside):
+        proposed = None
+        if swapped[i]:
+            proposed = "{},{}".format(points.lon[i], points.lat[i])
+        elif negated[i]:
+            proposed = "{},{}".format(points.lat[i], -points.lon[i])
+        problems.append({"entry_id": points.ids[i], "proposed": proposed,
+                         "message": "{}: coordinates {},{} are outside {}.".format(
+                             points.ids[i], points.lat[i], points.lon[i], points.states[i])})
+    return problems
+
+
+def leave_one_out_medians(values):
+    """For each value, the median of all the other values. Removing one value from a sorted array shifts everything
+    after it down by one, so each median can be read straight from the sorted array."""
+    order = np.argsort(values, kind="stable")
+    ranks = np.empty(len(values), dtype=int)
+    ranks[order] = np.arange(len(values))
+    sorted_values = values[order]
+    remaining = len(values) - 1
+
+    def nth_other(n):
+        return sorted_values[n + (n >= ranks)]
+
+    if remaining % 2:
+        return nth_other(remaining // 2)
+    return (nth_other(remaining // 2 - 1) + nth_other(remaining // 2)) / 2
+
+
+def find_city_outliers(points):
+    """Find entries far from the median location of the other entries in the same city."""
+    _, inverse, counts = np.unique(points.cities, return_inverse=True, return_counts=True)
+    median_lat = np.full(len(points.ids), np.nan)
+    median_lon = np.full(len(points.ids), np.nan)
+    order = np.argsort(inverse, kind="stable")
+    for members in np.split(order, np.cumsum(counts)[:-1]):
+        members = members[points.located[members]]
+        if len(members) > CITY_OUTLIER_MIN_ENTRIES:
+            median_lat[members] = leave_one_out_medians(points.lat[members])
+            median_lon[members] = leave_one_out_medians(points.lon[members])
+    distances = distance_km(points.lat, points.lon, median_lat, median_lon)
+    with np.errstate(invalid="ignore"):
+        outliers = np.flatnonzero(distances > CITY_OUTLIER_KM)
+    return [{"entry_id": points.ids[i], "proposed": None,
+             "message": "{}: coordinates {},{} are {:.0f} km from the other entries in {}, {}.".format(
+                 points.ids[i], points.lat[i], points.lon[i], distances[i], *points.cities[i].split("|"))}
+            for i in outliers]
+
+
+def find_near_duplicates(points):
+    """Find pairs of entries on the same day within DUPLICATE_DISTANCE_KM of each other. Points are binned into a grid
+    of cells that size, keyed by date and cell, so only points in neighboring cells on the same day are compared."""
+    located = np.flatnonzero(points.located)
+    lat, lon, dates = points.lat[located], points.lon[located], points.dates[located]
+    # Project onto a flat grid in kilometers. Every point uses the longitude scale of the highest latitude, where a
+    # degree of longitude is shortest, so no two points are closer on the grid than on the ground. Cells are
+    # DUPLICATE_DISTANCE_KM across, so any pair that close is in the same or a neighboring cell.
+    lon_scale = np.cos(np.radians(np.abs(lat).max())) if len(lat) else 1.0
+    cell_y = np.floor(lat * KM_PER_DEGREE / DUPLICATE_DISTANCE_KM).astype(np.int64)
+    cell_x = np.floor(lon * KM_PER_DEGREE * lon_scale / DUPLICATE_DISTANCE_KM).astype(np.int64)
+    offset = 1 << 20
+
+    def cell_keys(x, y):
+        return (dates << 42) | ((x + offset) << 21) | (y + offset)
+
+    keys = cell_keys(cell_x, cell_y)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    pairs = []
+    for dx in [-1, 0, 1]:
+        for dy in [-1, 0, 1]:
+            neighbors = cell_keys(cell_x + dx, cell_y + dy)
+            start = np.searchsorted(sorted_keys, neighbors, side="left")
+            counts = np.searchsorted(sorted_keys, neighbors, side="right") - start
+            first = np.repeat(np.arange(len(keys)), counts)
+            second = order[np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+            pairs.append(np.stack([first, second], axis=1))
+    pairs = np.concatenate(pairs)
+    pairs = pairs[pairs[:, 0] < pairs[:, 1]]
+    distances = distance_km(lat[pairs[:, 0]], lon[pairs[:, 0]], lat[pairs[:, 1]], lon[pairs[:, 1]])
+    pairs, distances = pairs[distances <= DUPLICATE_DISTANCE_KM], distances[distances <= DUPLICATE_DISTANCE_KM]
+    problems = []
+    for (first, second), distance in zip(located[pairs], distances):
+        entry_ids = sorted([points.ids[first], points.ids[second]])
+        problems.append({"entry_ids": entry_ids, "proposed": None,
+                         "message": "{} and {} are {:.2f} km apart on the same day, and may be duplicates.".format(
+                             entry_ids[0], entry_ids[1], distance)})
+    return problems
+
+
+def queue_problems(coordinate_problems, duplicates):
+    """Add the problems to the review file of each entry's year, skipping any that are already there."""
+    queues = {}
+    for problem in coordinate_problems + duplicates:
+        year = problem.get("entry_id", problem.get("entry_ids", [""])[0])[:4]
+        if year not in queues:
+            queues[year] = ReviewQueue.load(REVIEW_FILE.format(year=year))
+        queue = queues[year]
+        if any(conflict["message"].startswith(problem["message"]) for conflict in queue.conflicts):
+            continue
+        if "entry_id" in problem:
+            queue.add("coordinates", problem["message"] + " Decide with 'lat,lon'{} or 'reject' to keep them.".format(
+                ", 'accept' to use the proposed fix," if problem["proposed"] else ""), problem["proposed"],
+                entry_id=problem["entry_id"])
+        else:
+            queue.add("duplicate", problem["message"] + " Decide with the ID to remove, or 'reject' to keep both.",
+                      None, entry_ids=problem["entry_ids"])
+    for year, queue in queues.items():
+        queue.save(REVIEW_FILE.format(year=year))
+
+
+def validate(shootings_dict, queue=False):
+    """Check the entries' coordinates, print any problems, and optionally queue them for review. Returns the number
+    of problems found."""
+    with metrics.stage("load_points") as stage:
+        points = Points(shootings_dict)
+        stage["rows"] = len(points.ids)
+    with metrics.stage("check_bounds"):
+        coordinate_problems = check_bounds(points)
+    with metrics.stage("city_outliers"):
+        flagged = {problem["entry_id"] for problem in coordinate_problems}
+        coordinate_problems += [x for x in find_city_outliers(points) if x["entry_id"] not in flagged]
+    with metrics.stage("near_duplicates"):
+        duplicates = find_near_duplicates(points)
+    for problem in coordinate_problems + duplicates:
+        print(problem["message"])
+    if queue:
+        queue_problems(coordinate_problems, duplicates)
+    print("Checked {} entries: {} with suspicious coordinates, {} possible duplicates.".format(
+        len(points.ids), len(coordinate_problems), len(duplicates)))
+    return len(coordinate_problems) + len(duplicates)
+
+
+def main(argv=None, store=None):
+    args = parse_arguments(argv)
+    with instrumentation.run("validate", "all" if args.all else args.year):
+        owns_store = store is None
+        if owns_store:
+            store = open_store()
+        with metrics.stage("load"):
+            shootings_dict = store.load() if args.all else store.load(args.year)
+        if owns_store:
+            store.close()
+        validate(shootings_dict, args.queue)
+
+
+if __name__ == "__main__":
+    main()